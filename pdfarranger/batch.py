@@ -0,0 +1,277 @@
+# Copyright (C) 2025 pdfarranger contributors
+#
+# pdfarranger is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Arrange PDF files without the graphical user interface.
+
+Neither Gtk nor Poppler are imported, so this runs on headless servers::
+
+    python -m pdfarranger.batch -o out.pdf a.pdf b.pdf#3-5,8 blank c.pdf --rotate 90
+    python -m pdfarranger.batch --jobs 8 job1.json job2.json
+
+A JSON job file contains one job or a list of jobs::
+
+    {
+        "output": "out.pdf",
+        "pages": [
+            {"file": "a.pdf", "pages": "1-3", "rotate": 90},
+            {"blank": [595, 842], "count": 2},
+            {"file": "b.pdf", "password": "secret", "crop": [0.1, 0.1, 0, 0], "scale": 0.5}
+        ],
+        "nup": [2, 1],
+        "split": false
+    }
+
+"rotate" is clockwise in multiples of 90 degrees, "crop" (left, right, top,
+bottom) is a fraction of the page size before rotation, "nup" places (columns,
+rows) pages on each sheet and "split" writes one file per page. "blank": true inserts a blank page of
+the size of the previous page. "deduplicate", "profile" ("DEFAULT" or "FAX"),
+"linearize", "object_streams" and "compression_level" have the same meaning
+as the corresponding preferences of the application.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pikepdf
+
+from . import exporter
+from .pages import Dims, LayerPage, Page, Sides
+
+#: Size of blank pages which do not follow another page (Letter / ANSI A, like pikepdf)
+DEFAULT_SIZE = (612, 792)
+
+
+def parse_range(spec, npages):
+    """Page numbers (from 1) of a page range such as "1-3,7,9-".
+
+    >>> parse_range("1-3,7,9-", 10)
+    [1, 2, 3, 7, 9, 10]
+    >>> parse_range("", 3)
+    [1, 2, 3]
+    """
+    if spec is None or spec.strip() == "":
+        return list(range(1, npages + 1))
+    numbers = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        first = int(first) if first else 1
+        last = (int(last) if last else npages) if sep else first
+        if not 1 <= first <= last <= npages:
+            raise ValueError(f"Invalid page range {part!r} for a file of {npages} pages")
+        numbers.extend(range(first, last + 1))
+    return numbers
+
+
+def _page_size(pdf_page):
+    """Size of a page as displayed, i.e. what Poppler would report"""
+    x1, y1, x2, y2 = exporter._mediabox(pdf_page)
+    size = Dims(float(x2 - x1), float(y2 - y1))
+    angle = int(pdf_page.Rotate) if '/Rotate' in pdf_page else 0
+    return size.flipped() if angle % 180 == 90 else size
+
+
+class _Job:
+    """Build the files and pages lists expected by exporter.export_doc"""
+
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.files = []
+        self.pdfs = []
+        self.blank_files = {}
+
+    def nfile(self, filename, password=""):
+        for i, (name, _password) in enumerate(self.files):
+            if name == filename:
+                return i + 1
+        self.pdfs.append(pikepdf.open(filename, password=password))
+        self.files.append((filename, password))
+        return len(self.files)
+
+    def blank(self, size):
+        size = tuple(float(x) for x in size)
+        if size not in self.blank_files:
+            self.blank_files[size] = exporter._create_blank_page(self.tmpdir, size)
+        return self.nfile(self.blank_files[size])
+
+    def page(self, nfile, npage, angle=0, scale=1.0, crop=(0, 0, 0, 0)):
+        filename = self.files[nfile - 1][0]
+        size = _page_size(self.pdfs[nfile - 1].pages[npage - 1])
+        page = Page(nfile, npage, 1.0, filename, 0, scale, Sides(*crop), Sides(), size,
+                    os.path.basename(filename), [])
+        page.rotate(angle)
+        return page
+
+    def add(self, pages, entry):
+        """Append the pages described by one entry of the job "pages" list"""
+        if "blank" in entry:
+            size = entry["blank"]
+            if size is True:
+                size = pages[-1].size_in_points() if len(pages) > 0 else DEFAULT_SIZE
+            nfile = self.blank(size)
+            pages.extend(self.page(nfile, 1) for _ in range(entry.get("count", 1)))
+            return
+        angle = entry.get("rotate", 0)
+        if not isinstance(angle, int) or angle % 90 != 0:
+            raise ValueError(f"Invalid rotation {angle!r} in {entry!r}, it must be a multiple of 90")
+        nfile = self.nfile(entry["file"], entry.get("password", ""))
+        npages = len(self.pdfs[nfile - 1].pages)
+        for npage in parse_range(entry.get("pages"), npages):
+            pages.append(self.page(nfile, npage, angle, entry.get("scale", 1.0),
+                                   entry.get("crop", (0, 0, 0, 0))))
+
+    def nup(self, pages, cols, rows):
+        """Place the pages on sheets of cols x rows pages, like "Merge Pages" does"""
+        sheets = []
+        for first in range(0, len(pages), cols * rows):
+            group = pages[first:first + cols * rows]
+            wcell = max(p.width_in_points() for p in group)
+            hcell = max(p.height_in_points() for p in group)
+            wsheet, hsheet = wcell * cols, hcell * rows
+            sheet = self.page(self.blank((wsheet, hsheet)), 1)
+            for n, p in enumerate(group):
+                row, col = divmod(n, cols)
+                w, h = p.size_in_points()
+                left = (col * wcell + (wcell - w) / 2) / wsheet
+                top = (row * hcell + (hcell - h) / 2) / hsheet
+                offset = Sides(left, 1 - left - w / wsheet, top, 1 - top - h / hsheet)
+                sheet.layerpages.append(LayerPage(p.nfile, p.npage, p.copyname, p.angle, p.scale,
+                                                  p.crop, offset, 'OVERLAY', p.size_orig))
+            sheets.append(sheet)
+        return sheets
+
+
+def _output_files(output, npages, split):
+    """The output file names: out.pdf, out-002.pdf, out-003.pdf… when splitting"""
+    if not split:
+        return [output]
+    root, ext = os.path.splitext(output)
+    return [output] + [f"{root}-{n:03d}{ext}" for n in range(2, npages + 1)]
+
+
+def run_job(job):
+    """Run a single job (see the module documentation). Return the output files."""
+    with tempfile.TemporaryDirectory(prefix="pdfarranger-batch-") as tmpdir:
+        builder = _Job(tmpdir)
+        pages = []
+        for entry in job["pages"]:
+            builder.add(pages, entry)
+        if len(pages) == 0:
+            raise ValueError("No pages to export")
+        if job.get("nup"):
+            pages = builder.nup(pages, *job["nup"])
+        files_out = _output_files(job["output"], len(pages), job.get("split", False))
+        save_options = {k: job[k] for k in ("linearize", "object_streams", "compression_level")
+                        if k in job}
+        try:
+            exporter.export_doc(builder.pdfs, pages, {}, files_out, None,
+                                dedup=job.get("deduplicate", False),
+                                profile=job.get("profile", "DEFAULT"), save_options=save_options)
+        finally:
+            for pdf in builder.pdfs:
+                pdf.close()
+    return files_out
+
+
+def _run_job_noexcept(job):
+    try:
+        return run_job(job), None
+    except Exception as e:
+        return None, f"{job.get('output', '?')}: {e}"
+
+
+def _parse_item(item):
+    """Convert a FILE[#RANGE] or blank[=WxH] command line item to a job "pages" entry"""
+    if not os.path.exists(item):
+        name, sep, size = item.partition("=")
+        if name == "blank":
+            return {"blank": [float(x) for x in size.split("x")] if sep else True}
+    filename, _sep, pages = item.partition("#")
+    return {"file": filename, "pages": pages}
+
+
+def _command_line_job(args):
+    entry_options = {}
+    if args.rotate:
+        entry_options["rotate"] = args.rotate
+    if args.scale != 1:
+        entry_options["scale"] = args.scale
+    if args.crop:
+        entry_options["crop"] = [float(x) for x in args.crop.split(",")]
+    entries = [_parse_item(item) for item in args.items]
+    for entry in entries:
+        if "file" in entry:
+            entry.update(entry_options)
+    job = dict(output=args.output, pages=entries, split=args.split, deduplicate=args.deduplicate,
+               profile=args.profile, linearize=args.linearize)
+    if args.nup:
+        job["nup"] = [int(x) for x in args.nup.split("x")]
+    return job
+
+
+def _load_jobs(filenames):
+    jobs = []
+    for filename in filenames:
+        with open(filename, encoding="utf-8") as f:
+            data = json.load(f)
+        jobs.extend(data if isinstance(data, list) else [data])
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pdfarranger.batch",
+        description="Merge, rotate, crop, split and N-up PDF files without user interface.")
+    parser.add_argument("items", nargs="+", metavar="ITEM",
+                        help="FILE[#RANGE] or blank[=WxH] with -o, JSON job files otherwise")
+    parser.add_argument("-o", "--output", help="output file, jobs are read from JSON files if omitted")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of jobs to run concurrently")
+    parser.add_argument("--rotate", type=int, default=0,
+                        help="clockwise rotation in degrees, a multiple of 90")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--crop", metavar="L,R,T,B", help="crop fractions")
+    parser.add_argument("--nup", metavar="COLSxROWS", help="pages per sheet")
+    parser.add_argument("--split", action="store_true", help="write one file per page")
+    parser.add_argument("--deduplicate", action="store_true",
+                        help="merge identical images and fonts of different files")
+    parser.add_argument("--profile", choices=["DEFAULT", "FAX"], default="DEFAULT")
+    parser.add_argument("--linearize", action="store_true", help="optimize for fast web view")
+    args = parser.parse_args(argv)
+    if args.rotate % 90 != 0:
+        parser.error("--rotate must be a multiple of 90")
+
+    jobs = [_command_line_job(args)] if args.output else _load_jobs(args.items)
+    if len(jobs) == 1 or args.jobs == 1:
+        results = [_run_job_noexcept(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(_run_job_noexcept, jobs))
+    failed = 0
+    for files_out, error in results:
+        if error is None:
+            print("\n".join(files_out))
+        else:
+            print(error, file=sys.stderr)
+            failed += 1
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
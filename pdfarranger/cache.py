@@ -0,0 +1,63 @@
+# Copyright (C) 2025 pdfarranger contributors
+#
+# pdfarranger is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Caches shared by the in memory exports and the search"""
+
+import collections
+
+
+class LRUCache(collections.OrderedDict):
+    """A small least recently used cache calling on_evict for dropped values
+
+    >>> cache = LRUCache(2, on_evict=print)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    2
+    >>> cache.put('d', 4, keep={'a', 'c', 'd'})
+    >>> list(cache)
+    ['a', 'c', 'd']
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value, keep=()):
+        """Add value, the values of the keys in keep are not evicted"""
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            evicted = [k for k in self if k != key and k not in keep]
+            for k in evicted[:len(self) - self.maxsize]:
+                old = self.pop(k)
+                if self.on_evict is not None:
+                    self.on_evict(old)
+
+    def clear(self):
+        while len(self) > 0:
+            _key, old = self.popitem()
+            if self.on_evict is not None:
+                self.on_evict(old)
@@ -24,7 +24,7 @@ import pikepdf
 from gi.repository import Gdk
 from gi.repository import Gtk
 
-from .exporter import PrintSettingsWidget
+from .printing import PrintSettingsWidget
 
 _ = gettext.gettext
 
@@ -165,6 +165,8 @@ class Config(object):
             self.data.add_section('print-settings')
         if 'image-export' not in self.data:
             self.data.add_section('image-export')
+        if 'save-settings' not in self.data:
+            self.data.add_section('save-settings')
         if 'accelerators' not in self.data:
             self.data.add_section('accelerators')
         a = self.data['accelerators']
@@ -243,6 +245,18 @@ class Config(object):
             start_with_empty = True
         self.data.set('preferences', 'start-with-empty', str(start_with_empty))
 
+    def deduplicate_resources(self):
+        return self.data.getboolean('preferences', 'deduplicate-resources', fallback=False)
+
+    def set_deduplicate_resources(self, enabled):
+        self.data.set('preferences', 'deduplicate-resources', str(enabled))
+
+    def fax_optimize(self):
+        return self.data.getboolean('preferences', 'fax-optimize', fallback=True)
+
+    def set_fax_optimize(self, enabled):
+        self.data.set('preferences', 'fax-optimize', str(enabled))
+
     def scale_mode(self):
         return self.data.get('print-settings', 'scale-mode', fallback="PRINTABLE")
 
@@ -255,6 +269,67 @@ class Config(object):
     def set_auto_rotate(self, enabled):
         self.data.set('print-settings', 'auto-rotate', str(enabled))
 
+    def linearize(self):
+        return self.data.getboolean('save-settings', 'linearize', fallback=False)
+
+    def set_linearize(self, enabled):
+        self.data.set('save-settings', 'linearize', str(enabled))
+
+    def object_streams(self):
+        """One of 'preserve', 'disable' or 'generate'"""
+        return self.data.get('save-settings', 'object-streams', fallback="preserve")
+
+    def set_object_streams(self, mode):
+        self.data.set('save-settings', 'object-streams', mode)
+
+    def compression_level(self):
+        """Flate compression level from 0 to 9, -1 to keep streams as they are"""
+        return self.data.getint('save-settings', 'compression-level', fallback=-1)
+
+    def set_compression_level(self, level):
+        self.data.set('save-settings', 'compression-level', str(level))
+
+    def compression(self):
+        """Compression preset shown in the save dialog"""
+        if self.compression_level() >= 0:
+            return 'MAXIMUM'
+        return 'COMPACT' if self.object_streams() == 'generate' else 'DEFAULT'
+
+    def set_compression(self, preset):
+        self.set_object_streams('preserve' if preset == 'DEFAULT' else 'generate')
+        self.set_compression_level(9 if preset == 'MAXIMUM' else -1)
+
+    def incremental_save(self):
+        return self.data.getboolean('save-settings', 'incremental', fallback=False)
+
+    def set_incremental_save(self, enabled):
+        self.data.set('save-settings', 'incremental', str(enabled))
+
+    def chunk_size(self):
+        """Number of pages exported at once, 0 to export all pages at once"""
+        return self.data.getint('save-settings', 'chunk-size', fallback=0)
+
+    def set_chunk_size(self, npages):
+        self.data.set('save-settings', 'chunk-size', str(npages))
+
+    def undo_steps(self):
+        """Maximum number of undo steps, 0 for no limit"""
+        return self.data.getint('preferences', 'undo-steps', fallback=0)
+
+    def set_undo_steps(self, nsteps):
+        self.data.set('preferences', 'undo-steps', str(nsteps))
+
+    def undo_memory(self):
+        """Memory (MiB) used by the undo history before the oldest steps are written to disk"""
+        return self.data.getint('preferences', 'undo-memory', fallback=64)
+
+    def set_undo_memory(self, mib):
+        self.data.set('preferences', 'undo-memory', str(mib))
+
+    def save_options(self):
+        return dict(linearize=self.linearize(), object_streams=self.object_streams(),
+                    compression_level=self.compression_level())
+
     def image_ppi(self):
         return self.data.getint('image-export', 'image-ppi', fallback=150)
 
@@ -273,6 +348,19 @@ class Config(object):
     def set_greyscale(self, greyscale):
         self.data.set('image-export', 'greyscale', str(greyscale))
 
+    def tiff_resolution(self):
+        """'FINE' (204x196 dpi) or 'STANDARD' (204x98 dpi) fax tiff export"""
+        return self.data.get('image-export', 'tiff-resolution', fallback="FINE")
+
+    def set_tiff_resolution(self, resolution):
+        self.data.set('image-export', 'tiff-resolution', resolution)
+
+    def tiff_dither(self):
+        return self.data.getboolean('image-export', 'tiff-dither', fallback=False)
+
+    def set_tiff_dither(self, dither):
+        self.data.set('image-export', 'tiff-dither', str(dither))
+
     def save(self):
         conffile = Config._config_file(self.domain)
         os.makedirs(os.path.dirname(conffile), exist_ok=True)
@@ -309,8 +397,11 @@ class Config(object):
             if k != "enable_custom"
         ]
 
-    def preferences_dialog(self, parent, handy_available):
-        """A dialog for some application preferences."""
+    def preferences_dialog(self, parent, handy_available, undo_usage=None):
+        """A dialog for some application preferences.
+
+        undo_usage is (steps, bytes in memory, bytes on disk), see undo.Manager.usage.
+        """
         d = Gtk.Dialog(title=_("Preferences"),
                        parent=parent,
                        flags=Gtk.DialogFlags.MODAL,
@@ -351,6 +442,26 @@ class Config(object):
         else:
             # prevent CodeQL false positive "uninitialized local variable"
             cb_retain = None
+        frame7 = Gtk.Frame(label=_("Saving/exporting"), margin=8)
+        cb_dedup = Gtk.CheckButton(
+            label=_("Merge identical images and fonts of different files"), margin=8)
+        cb_dedup.set_active(self.deduplicate_resources())
+        cb_incremental = Gtk.CheckButton(
+            label=_("Only append changes when pages of a file are reordered or removed\n"
+                    "(faster, but removed pages remain in the file)"), margin=8)
+        cb_incremental.set_active(self.incremental_save())
+        box7 = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box7.pack_start(cb_dedup, False, False, 0)
+        box7.pack_start(cb_incremental, False, False, 0)
+        grid7 = Gtk.Grid(row_spacing=6, column_spacing=12, border_width=8)
+        grid7.attach(Gtk.Label(_("Pages exported at once (0: all):")), 0, 0, 1, 1)
+        sb_chunk_size = Gtk.SpinButton.new_with_range(0, 100000, 100)
+        sb_chunk_size.props.width_chars = 8
+        sb_chunk_size.set_value(self.chunk_size())
+        grid7.attach(sb_chunk_size, 1, 0, 1, 1)
+        box7.pack_start(grid7, False, False, 0)
+        frame7.add(box7)
+        d.vbox.pack_start(frame7, False, False, 8)
         frame5 = Gtk.Frame(label=_("Image Export"), margin=8)
         grid5 = Gtk.Grid(row_spacing=6, column_spacing=12, border_width=12)
         label5 = Gtk.Label(_("Pixels/inch:"))
@@ -367,6 +478,28 @@ class Config(object):
         grid5.attach(cb_greyscale, 1, 2, 1, 1)
         frame5.add(grid5)
         d.vbox.pack_start(frame5, False, False, 8)
+        frame8 = Gtk.Frame(label=_("Undo"), margin=8)
+        grid8 = Gtk.Grid(row_spacing=6, column_spacing=12, border_width=8)
+        grid8.attach(Gtk.Label(_("Undo steps (0: unlimited):"), halign=Gtk.Align.START),
+                     0, 0, 1, 1)
+        sb_undo_steps = Gtk.SpinButton.new_with_range(0, 100000, 10)
+        sb_undo_steps.props.width_chars = 8
+        sb_undo_steps.set_value(self.undo_steps())
+        grid8.attach(sb_undo_steps, 1, 0, 1, 1)
+        grid8.attach(Gtk.Label(_("Memory before writing older steps to disk (MiB):"),
+                               halign=Gtk.Align.START), 0, 1, 1, 1)
+        sb_undo_memory = Gtk.SpinButton.new_with_range(1, 100000, 16)
+        sb_undo_memory.props.width_chars = 8
+        sb_undo_memory.set_value(self.undo_memory())
+        grid8.attach(sb_undo_memory, 1, 1, 1, 1)
+        if undo_usage is not None:
+            steps, memory, disk = undo_usage
+            usage = _("Current history: {} steps, {:.1f} MiB in memory, {:.1f} MiB on disk")
+            label8 = Gtk.Label(usage.format(steps, memory / 2**20, disk / 2**20),
+                               halign=Gtk.Align.START, selectable=True)
+            grid8.attach(label8, 0, 2, 2, 1)
+        frame8.add(grid8)
+        d.vbox.pack_start(frame8, False, False, 8)
         t = _("For more options see:")
         frame6 = Gtk.Frame(label=t, shadow_type=Gtk.ShadowType.NONE, margin=8)
         label6 = Gtk.Label(self._config_file(self.domain), selectable=True, margin=8)
@@ -401,6 +534,11 @@ class Config(object):
             self.set_theme(theme)
             if self.has_pikepdf8:
                 self.set_start_with_empty(not cb_retain.get_active())
+            self.set_deduplicate_resources(cb_dedup.get_active())
+            self.set_incremental_save(cb_incremental.get_active())
+            self.set_chunk_size(sb_chunk_size.get_value_as_int())
+            self.set_undo_steps(sb_undo_steps.get_value_as_int())
+            self.set_undo_memory(sb_undo_memory.get_value_as_int())
             self.set_scale_mode(psettings.get_scale_mode())
             self.set_auto_rotate(psettings.get_auto_rotate())
             self.set_image_ppi(sb_image_ppi.get_value_as_int())
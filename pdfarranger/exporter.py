@@ -22,18 +22,25 @@ import sys
 import warnings
 import tempfile
 import io
-import gi
+import hashlib
 import locale
+import math
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List
 
 from . import metadata
-from gi.repository import Gtk
-gi.require_version("Poppler", "0.18")
-from gi.repository import Poppler
 import gettext
 _ = gettext.gettext
 
-from .core import Page, Sides
+from .pages import Page, Sides
+
+try:
+    import img2pdf
+except ImportError:
+    img2pdf = None
+
+#: Resolution (dpi) of the images in the fax export profile
+FAX_DPI = 200
 
 # pikepdf.Page.add_overlay()/add_underlay() can't place a page exactly
 # if for example LC_NUMERIC=fi_FI
@@ -47,8 +54,12 @@ if os.name == 'nt':
     locale.setlocale(locale.LC_COLLATE, 'C')
 
 
+#: Minimal number of pages of the blank documents, see get_blank_doc
+BLANK_DOC_MIN_PAGES = 8
+
+
 def get_blank_doc(pageadder, pdfqueue, tmpdir, size, npages=1):
-    """Search pdfqueue for a matching pdf with blank pages. Create it if it does not exist.
+    """Search pdfqueue for a pdf with at least npages blank pages. Create it if it does not exist.
 
     Some notes:
     Blank pdf documents are created prior to export (vs created as needed at export)
@@ -56,14 +67,17 @@ def get_blank_doc(pageadder, pdfqueue, tmpdir, size, npages=1):
     extra for rendering of a blank page.
 
     A document with several blank pages is needed if the page number under thumbnail
-    need to be something else than 1.
+    need to be something else than 1. Documents are created with a power of two
+    number of pages so that a single document serves most requests of a given size
+    and repeated merges or booklets do not keep growing pdfqueue.
     """
     for i, pdfdoc in enumerate(pdfqueue):
-        if size == pdfdoc.blank_size and npages == pdfdoc.document.get_n_pages():
+        if size == pdfdoc.blank_size and npages <= pdfdoc.document.get_n_pages():
             filename = pdfdoc.copyname
             nfile = i + 1
             return filename, nfile
-    filename = _create_blank_page(tmpdir, size, npages)
+    capacity = max(BLANK_DOC_MIN_PAGES, 1 << (npages - 1).bit_length())
+    filename = _create_blank_page(tmpdir, size, capacity)
     doc_data = pageadder.get_pdfdoc(filename, description=None, blank_size=size)
     if doc_data is None:
         return None, None
@@ -71,6 +85,16 @@ def get_blank_doc(pageadder, pdfqueue, tmpdir, size, npages=1):
     return filename, nfile
 
 
+def add_blank_pages(pageadder, pdfqueue, tmpdir, size, npages=1):
+    """Add npages blank pages of the given size to pageadder. Return the blank file name."""
+    filename, _nfile = get_blank_doc(pageadder, pdfqueue, tmpdir, size, npages)
+    if filename is None:
+        return None
+    for npage in range(1, npages + 1):
+        pageadder.addpages(filename, npage)
+    return filename
+
+
 def _create_blank_page(tmpdir, size, npages=1):
     """
     Create a temporary PDF file with npages empty pages.
@@ -191,6 +215,14 @@ def _update_angle(model_page, source_page, output_page):
         output_page.Rotate = new_angle
 
 
+def _unmodified(row):
+    """True if the page is exported as is: no rotation, crop, scale or layers.
+
+    Same as Page.unmodified() but hidden margins are already applied at export.
+    """
+    return row.angle == 0 and row.scale == 1 and row.crop == Sides() and len(row.layerpages) == 0
+
+
 def _apply_geom_transform(pdf_output, new_page, row):
     _update_angle(row, new_page, new_page)
     new_page.MediaBox = _mediabox(new_page, row.crop)
@@ -217,9 +249,72 @@ def _apply_geom_transform_job(pdf_output:pikepdf.Pdf, new_page:pikepdf.Page, pag
 
 
 
-def _remove_unreferenced_resources(pdfdoc):
+def _resource_ids(page):
+    """Return the ids of the indirect resource objects a page refers to.
+
+    None is returned in the list if the page inherits its resources from the
+    page tree, which means they are shared with other pages.
+    """
+    if '/Resources' not in page.obj:
+        return [None]
+    resources = page.obj.Resources
+    ids = []
+    if resources.is_indirect:
+        ids.append(resources.objgen)
+    for v in resources.values():
+        if isinstance(v, pikepdf.Dictionary) and v.is_indirect:
+            ids.append(v.objgen)
+    return ids
+
+
+def _shared_resources(pdf):
+    """Return the ids of resource objects which are used by more than one page of pdf."""
+    seen = set()
+    shared = {None}
+    for page in pdf.pages:
+        for rid in _resource_ids(page):
+            if rid in seen:
+                shared.add(rid)
+            seen.add(rid)
+    return shared
+
+
+def _resources_to_prune(pdf_input, pages):
+    """Return a list telling for each output page if its resources must be pruned.
+
+    A source page which does not share its resources with other pages is assumed to
+    only have the resources it uses, so there is nothing to remove. Pages which share
+    resource dictionaries in their source document may get resources which belong to
+    other pages and must be analysed.
+    """
+    shared = {}
+    prune = []
+    for row in pages:
+        candidate = False
+        for p in [row] + list(row.layerpages):
+            pdf = pdf_input[p.nfile - 1]
+            if p.nfile not in shared:
+                shared[p.nfile] = _shared_resources(pdf)
+            source_page = pdf.pages[p.npage - 1]
+            if any(rid in shared[p.nfile] for rid in _resource_ids(source_page)):
+                candidate = True
+                break
+        prune.append(candidate)
+    return prune
+
+
+def _remove_unreferenced_resources(pdfdoc, prune=None):
+    """Remove unreferenced resources of pdfdoc.
+
+    If prune is given, only the pages for which it is True are analysed.
+    """
     try:
-        pdfdoc.remove_unreferenced_resources()
+        if prune is None:
+            pdfdoc.remove_unreferenced_resources()
+        else:
+            for page, p in zip(pdfdoc.pages, prune):
+                if p:
+                    page.remove_unreferenced_resources()
     except RuntimeError:
 	# Catch "RuntimeError: operation for dictionary attempted on object of
 	# type null" with old version PikePDF (observed with 1.17 and 1.19).
@@ -227,6 +322,165 @@ def _remove_unreferenced_resources(pdfdoc):
 	# unwanted exception so we print it.
         print(traceback.format_exc())
 
+def _canonical(obj, top=True):
+    """Return a hashable description of obj where indirect objects are only referenced."""
+    if not top and isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        return 'R', obj.objgen
+    if isinstance(obj, pikepdf.Stream):
+        obj = obj.stream_dict
+    if isinstance(obj, pikepdf.Dictionary):
+        return tuple(sorted((k, _canonical(v, False)) for k, v in obj.items()
+                            if k not in ('/Length', '/Filter', '/DecodeParms')))
+    if isinstance(obj, pikepdf.Array):
+        return tuple(_canonical(v, False) for v in obj)
+    return repr(obj)
+
+
+def _stream_key(stream):
+    """Fingerprint of a stream: hash of its decoded content and its dictionary."""
+    try:
+        data = stream.read_bytes()
+    except pikepdf.PdfError:
+        data = stream.read_raw_bytes()
+    return hashlib.sha256(data).digest(), _canonical(stream)
+
+
+def _deduplicate_resources(pdfdoc):
+    """Make identical images, fonts and forms of pdfdoc share a single object.
+
+    Pages copied from different input files keep their own copy of resources even
+    if they are identical (logos, fonts, cover sheets...). Streams found in the
+    page resources, and the indirect dictionaries referencing them (such as fonts),
+    are fingerprinted and references to duplicates are replaced by references to
+    the first occurrence. Duplicates are then not written anymore.
+    """
+    canonical = {}
+    # objgen of visited objects -> the object replacing it or None
+    visited = {}
+
+    def dedup(container, keys):
+        for k in keys:
+            v = container[k]
+            if not isinstance(v, (pikepdf.Dictionary, pikepdf.Array, pikepdf.Stream)):
+                continue
+            if v.is_indirect:
+                if v.objgen in visited:
+                    if visited[v.objgen] is not None:
+                        container[k] = visited[v.objgen]
+                    continue
+                visited[v.objgen] = None
+            # Children first so that duplicated children are already merged
+            # when the parent is fingerprinted
+            if isinstance(v, pikepdf.Array):
+                dedup(v, range(len(v)))
+            else:
+                dedup(v, [key for key in v.keys() if key not in ('/Parent', '/P')])
+            if v.is_indirect:
+                key = _stream_key(v) if isinstance(v, pikepdf.Stream) else _canonical(v)
+                first = canonical.setdefault(key, v)
+                if first.objgen != v.objgen:
+                    visited[v.objgen] = first
+                    container[k] = first
+
+    for page in pdfdoc.pages:
+        if '/Resources' in page.obj:
+            dedup(page.obj, ['/Resources'])
+
+
+def _fax_images(pdfdoc, dpi):
+    """Return the image XObjects of pdfdoc and the largest size (pixels) they need at dpi."""
+    images = {}
+    visited = set()
+
+    def walk(resources, limit):
+        xobjects = resources.get('/XObject', pikepdf.Dictionary())
+        for xobj in xobjects.values():
+            if not isinstance(xobj, pikepdf.Stream) or xobj.objgen in visited:
+                continue
+            subtype = xobj.get('/Subtype')
+            if subtype == '/Form':
+                visited.add(xobj.objgen)
+                if '/Resources' in xobj:
+                    walk(xobj.Resources, limit)
+            elif subtype == '/Image' and not xobj.get('/ImageMask', False):
+                if xobj.get('/BitsPerComponent') == 1:
+                    continue  # Already black & white
+                _img, old_limit = images.get(xobj.objgen, (xobj, 0))
+                images[xobj.objgen] = xobj, max(limit, old_limit)
+
+    for page in pdfdoc.pages:
+        x1, y1, x2, y2 = _mediabox(page)
+        limit = math.ceil(max(x2 - x1, y2 - y1) * dpi / 72)
+        if '/Resources' in page.obj:
+            walk(page.obj.Resources, limit)
+    return list(images.values())
+
+
+def _bilevel_g4(image, limit):
+    """Downsample a PIL image, dither it to black & white and encode it with CCITT G4.
+
+    Returns the encoded data, the image size and if black pixels are encoded as 1.
+    """
+    factor = min(1, limit / max(image.size))
+    size = max(1, round(image.width * factor)), max(1, round(image.height * factor))
+    image = image.convert('L')
+    if image.size != size:
+        image = image.resize(size, img2pdf.Image.LANCZOS)
+    image = image.convert('1')
+    buf = io.BytesIO()
+    # A single strip so that the G4 data is contiguous
+    image.save(buf, 'TIFF', compression='group4', tiffinfo={278: image.height})
+    tiff = img2pdf.Image.open(buf)
+    offset, length = tiff.tag_v2[273][0], tiff.tag_v2[279][0]
+    black_is_1 = tiff.tag_v2.get(262) == 1
+    return buf.getvalue()[offset:offset + length], size, black_is_1
+
+
+def _fax_optimize(pdfdoc, dpi=FAX_DPI, quit_flag=None):
+    """Replace the images of pdfdoc with black & white CCITT G4 images at fax resolution.
+
+    Fax carriers rasterize the documents as bilevel images anyway, so color or high
+    resolution images only make the upload larger. Images are encoded in a thread
+    pool as PIL releases the GIL while resizing and encoding.
+    """
+    if img2pdf is None:
+        warnings.warn(_("Image processing is only supported with img2pdf"))
+        return
+    images = _fax_images(pdfdoc, dpi)
+    nworkers = os.cpu_count() or 1
+    with ThreadPoolExecutor(nworkers) as pool:
+        for first in range(0, len(images), nworkers):
+            if quit_flag is not None and quit_flag.is_set():
+                return
+            batch = []
+            for xobj, limit in images[first:first + nworkers]:
+                try:
+                    pil = pikepdf.PdfImage(xobj).as_pil_image()
+                except Exception:
+                    # Image types not supported by pikepdf are kept unchanged
+                    continue
+                batch.append((xobj, pool.submit(_bilevel_g4, pil, limit)))
+            for xobj, future in batch:
+                data, (w, h), black_is_1 = future.result()
+                parms = pikepdf.Dictionary(K=-1, Columns=w, Rows=h, BlackIs1=black_is_1)
+                xobj.write(data, filter=pikepdf.Name.CCITTFaxDecode, decode_parms=parms)
+                xobj.Width = w
+                xobj.Height = h
+                xobj.BitsPerComponent = 1
+                xobj.ColorSpace = pikepdf.Name.DeviceGray
+                for key in ('/Decode', '/Intent', '/Mask'):
+                    if key in xobj:
+                        del xobj[key]
+
+
+def optimize_for_fax(file_in, file_out, password=""):
+    """Write file_in to file_out with the images converted for fax transmission."""
+    with pikepdf.open(file_in, password=password) as pdf:
+        _fax_optimize(pdf)
+        pdf.remove_unreferenced_resources()
+        pdf.save(file_out)
+
+
 def warn_dialog(func):
     """ Decorator which redirect warnings and error messages to a gtk MessageDialog """
     class ShowWarning:
@@ -240,6 +494,8 @@ def warn_dialog(func):
             self.buffer += str(message) + '\n'
 
     def wrapper(*args, **kwargs):
+        # Gtk is only needed by the GUI, the exporter itself runs without it (see batch.py)
+        from gi.repository import Gtk
         export_msg = kwargs["export_msg"]
         backup_showwarning = warnings.showwarning
         warnings.showwarning = ShowWarning()
@@ -277,13 +533,15 @@ def _copy_n_transform(pdf_input, pdf_output, pages, quit_flag=None):
             layer_page = pdf_input[lprow.nfile - 1].pages[lprow.npage - 1]
             _append_page(layer_page, copied_pages, pdf_output, lprow)
 
-    # Apply geometrical transformations in the output PDF file
+    # Apply geometrical transformations in the output PDF file. Unmodified pages
+    # only need a default MediaBox if they have none.
     i = 0
     for row in pages:
         if quit_flag is not None and quit_flag.is_set():
             return
 
-        pdf_output.pages[i] = _apply_geom_transform(pdf_output, pdf_output.pages[i], row)
+        if not _unmodified(row) or '/MediaBox' not in pdf_output.pages[i]:
+            pdf_output.pages[i] = _apply_geom_transform(pdf_output, pdf_output.pages[i], row)
         for lprow in row.layerpages:
             i += 1
             pdf_output.pages[i] = _apply_geom_transform(pdf_output, pdf_output.pages[i], lprow)
@@ -349,6 +607,9 @@ def _transform_job(pdf_output: pikepdf.Pdf, pages: List[Page], quit_flag = None)
         if quit_flag is not None and quit_flag.is_set():
             return
         mediaboxes.append(pikepdf.Rectangle(pdf_output.pages[i].mediabox))
+        if _unmodified(page):
+            i += 1
+            continue
         _apply_geom_transform_job(pdf_output, pdf_output.pages[i], page)
         for lpage in page.layerpages:
             i += 1
@@ -357,6 +618,8 @@ def _transform_job(pdf_output: pikepdf.Pdf, pages: List[Page], quit_flag = None)
 
     # # Add overlays and underlays
     for i, page in enumerate(pages):
+        if len(page.layerpages) == 0:
+            continue
         # The dest page coordinates and size before geometrical transformations
         mb = mediaboxes[i]
 
@@ -380,6 +643,35 @@ def _transform_job(pdf_output: pikepdf.Pdf, pages: List[Page], quit_flag = None)
             del pdf_output.pages[i + 1]
 
 
+def save_kwargs(save_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert save options (see Config.save_options) to pikepdf.Pdf.save() arguments."""
+    kwargs = {}
+    if save_options.get('linearize', False):
+        kwargs['linearize'] = True
+    mode = save_options.get('object_streams', 'preserve')
+    if mode != 'preserve':
+        kwargs['object_stream_mode'] = pikepdf.ObjectStreamMode[mode]
+    level = save_options.get('compression_level', -1)
+    if level >= 0:
+        # The level is a global setting. This is fine as export runs in its own process.
+        pikepdf.settings.set_flate_compression_level(level)
+        kwargs['recompress_flate'] = True
+    return kwargs
+
+
+def _job_save_options(json: Dict[str, Any], save_options: Dict[str, Any]) -> None:
+    """Same as save_kwargs but for the pikepdf Job interface."""
+    if save_options.get('linearize', False):
+        json["linearize"] = ""
+    mode = save_options.get('object_streams', 'preserve')
+    if mode != 'preserve':
+        json["objectStreams"] = mode
+    level = save_options.get('compression_level', -1)
+    if level >= 0:
+        json["compressionLevel"] = str(level)
+        json["recompressFlate"] = ""
+
+
 def get_max_pdf_version(pdf_list: List[pikepdf.Pdf]) -> str:
     """Return the highest pdf version used in pdf list"""
     versions = []
@@ -391,16 +683,23 @@ def get_max_pdf_version(pdf_list: List[pikepdf.Pdf]) -> str:
     return max(*versions)
 
 
-def export_doc(pdf_input, pages, mdata, files_out, quit_flag, test_mode=False):
+def export_doc(pdf_input, pages, mdata, files_out, quit_flag, test_mode=False, dedup=False,
+               profile='DEFAULT', save_options=None):
     """Same as export() but with pikepdf.PDF objects instead of files"""
+    kwargs = save_kwargs(save_options or {})
     pdf_output = pikepdf.Pdf.new()
     max_version = get_max_pdf_version([pdf_output, *pdf_input])
     _copy_n_transform(pdf_input, pdf_output, pages, quit_flag)
     if quit_flag is not None and quit_flag.is_set():
         return
+    if dedup:
+        _deduplicate_resources(pdf_output)
+    if profile == 'FAX':
+        _fax_optimize(pdf_output, quit_flag=quit_flag)
     if isinstance(files_out[0], str):
         # Only needed when saving to file, not when printing
         mdata = metadata.merge_doc(mdata, pdf_input)
+        prune = _resources_to_prune(pdf_input, pages)
     if len(files_out) > 1:
         for n, page in enumerate(pdf_output.pages):
             if quit_flag is not None and quit_flag.is_set():
@@ -409,20 +708,20 @@ def export_doc(pdf_input, pages, mdata, files_out, quit_flag, test_mode=False):
             _set_meta(mdata, pdf_input, outpdf)
             # works without make_indirect as already applied to this page
             outpdf.pages.append(page)
-            _remove_unreferenced_resources(outpdf)
-            outpdf.save(files_out[n], min_version=max_version)
+            _remove_unreferenced_resources(outpdf, prune[n:n + 1])
+            outpdf.save(files_out[n], min_version=max_version, **kwargs)
     else:
         if isinstance(files_out[0], str):
             if not test_mode:
                 _set_meta(mdata, pdf_input, pdf_output)
-            _remove_unreferenced_resources(pdf_output)
+            _remove_unreferenced_resources(pdf_output, prune)
         if test_mode:
             pdf_output.save(files_out[0], qdf=True, static_id=True, compress_streams=False,
                 stream_decode_level=pikepdf.StreamDecodeLevel.all,
                 min_version=max_version,
             )
         else:
-            pdf_output.save(files_out[0], min_version=max_version)
+            pdf_output.save(files_out[0], min_version=max_version, **kwargs)
 
 
 def _add_json_entries(json: Dict[str, Any], files: List[List[str]], page: Page) -> None:
@@ -435,14 +734,17 @@ def _add_json_entries(json: Dict[str, Any], files: List[List[str]], page: Page)
 
 
 def _create_job(files: List[List[str]], pages: List[Page], files_out: List[str], quit_flag=None,
-                test_mode: bool = False):
+                test_mode: bool = False, save_options: Dict[str, Any] = None):
     """ Same as _copy_n_transform, except it use the pikepdf Job interface. Requires pikepdf >= 8.0 """
     # Generate the output PDF file including temporary overlay/ underlay pages. We don't need to call
     # _append_page as the Job interface copies pages / annotations as necessary. We can also delay getting
     # our MediaBoxes until the transformation stage.
-    json = dict(outputFile=files_out[0], pages=[], removeUnreferencedResources="yes")
+    # "auto" let qpdf only remove unreferenced resources when pages share them
+    json = dict(outputFile=files_out[0], pages=[], removeUnreferencedResources="auto")
     if test_mode:
         json.update(qdf="", staticId="", compressStreams="n", decodeLevel="all")
+    else:
+        _job_save_options(json, save_options or {})
     if len(files) > 0 and len(files[0][0]) > 0:
         json["inputFile"] = files[0][0]  # We are treating files [0] as the main document
         if len(files[0][1]) > 0:
@@ -461,9 +763,10 @@ def _create_job(files: List[List[str]], pages: List[Page], files_out: List[str],
 
 
 def export_doc_job(pdf_input: List[pikepdf.Pdf], files: List[List[str]], pages: List[Page], mdata, files_out: List[str],
-                   quit_flag, test_mode: bool = False) -> None:
+                   quit_flag, test_mode: bool = False, dedup: bool = False,
+                   profile: str = 'DEFAULT', save_options: Dict[str, Any] = None) -> None:
     """  Same as export() but uses the pikepdf Job interface. Requires pikedf >= 8.0. """
-    job = _create_job(files, pages, files_out, quit_flag, test_mode)
+    job = _create_job(files, pages, files_out, quit_flag, test_mode, save_options)
     pdf_output = job.create_pdf()
     max_version = get_max_pdf_version([pdf_output, *pdf_input])
 
@@ -471,32 +774,237 @@ def export_doc_job(pdf_input: List[pikepdf.Pdf], files: List[List[str]], pages:
 
     if quit_flag is not None and quit_flag.is_set():
         return
+    if dedup:
+        _deduplicate_resources(pdf_output)
+    if profile == 'FAX':
+        _fax_optimize(pdf_output, quit_flag=quit_flag)
     if isinstance(files_out[0], str):
         # Only needed when saving to file, not when printing
         mdata = metadata.merge_doc(mdata, pdf_input)
     if len(files_out) > 1:
+        prune = _resources_to_prune(pdf_input, pages)
         for n, page in enumerate(pdf_output.pages):
             if quit_flag is not None and quit_flag.is_set():
                 return
             outpdf = pikepdf.Pdf.new()
             _set_meta(mdata, pdf_input, outpdf)
             outpdf.pages.append(page)
-            _remove_unreferenced_resources(outpdf)
-            outpdf.save(files_out[n], min_version=max_version)
+            _remove_unreferenced_resources(outpdf, prune[n:n + 1])
+            outpdf.save(files_out[n], min_version=max_version, **save_kwargs(save_options or {}))
     else:
         if isinstance(files_out[0], str) and not test_mode:
             _set_meta(mdata, [pdf_output], pdf_output)
         job.write_pdf(pdf_output)
 
 
-def export(files, pages, mdata, files_out, config, quit_flag, test_mode=False, **kwargs):
+def export_doc_chunked(files, pages, mdata, files_out, quit_flag, chunk_size, dedup=False,
+                       profile='DEFAULT', save_options=None):
+    """Same as export() but only export chunk_size pages at once.
+
+    Each chunk is exported with freshly opened input files to a temporary file,
+    so memory usage is bounded by the chunk size rather than the document size.
+    The chunks are then stitched together, qpdf only copying their streams
+    while writing the output file. Resources shared by pages of different
+    chunks are stored once per chunk unless dedup is set.
+    """
+    def open_input():
+        return [pikepdf.open(copyname, password=password) for copyname, password in files]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        chunk_files = []
+        for first in range(0, len(pages), chunk_size):
+            if quit_flag is not None and quit_flag.is_set():
+                return
+            if len(files_out) > 1:
+                chunk_out = files_out[first:first + chunk_size]
+            else:
+                chunk_out = [os.path.join(tmpdir, f'{first}.pdf')]
+                chunk_files.append(chunk_out[0])
+            pdf_input = open_input()
+            try:
+                export_doc(pdf_input, pages[first:first + chunk_size], mdata, chunk_out, quit_flag,
+                           dedup=dedup, profile=profile,
+                           save_options=save_options if len(files_out) > 1 else None)
+            finally:
+                for pdf in pdf_input:
+                    pdf.close()
+        if len(files_out) > 1 or (quit_flag is not None and quit_flag.is_set()):
+            return
+
+        pdf_input = open_input()
+        chunks = [pikepdf.open(f) for f in chunk_files]
+        pdf_output = pikepdf.Pdf.new()
+        for chunk in chunks:
+            pdf_output.pages.extend(chunk.pages)
+        if dedup:
+            # Resources shared by pages of different chunks were copied once per chunk
+            _deduplicate_resources(pdf_output)
+        _set_meta(metadata.merge_doc(mdata, pdf_input), pdf_input, pdf_output)
+        max_version = get_max_pdf_version([pdf_output, *pdf_input])
+        pdf_output.save(files_out[0], min_version=max_version, **save_kwargs(save_options or {}))
+        for pdf in chunks + pdf_input:
+            pdf.close()
+
+
+def _source_to_update(files, sources, pages, files_out):
+    """Return the index of the input file if the export only reorders or removes pages of
+    the file being overwritten, None otherwise."""
+    if len(files_out) != 1 or not isinstance(files_out[0], str) or len(pages) == 0:
+        return None
+    nfile = pages[0].nfile
+    for page in pages:
+        if (page.nfile != nfile or page.angle != 0 or page.scale != 1
+                or page.crop != Sides() or len(page.layerpages) > 0):
+            return None
+    if len(set(page.npage for page in pages)) != len(pages):
+        return None
+    filename, stat = sources[nfile - 1]
+    if len(files[nfile - 1][1]) > 0 or not os.path.exists(files_out[0]):
+        return None
+    s = os.stat(filename)
+    if (s.st_dev, s.st_ino, s.st_mtime) != stat or not os.path.samefile(filename, files_out[0]):
+        # The file was modified since it was opened
+        return None
+    return nfile - 1
+
+
+def _page_tree_leaves(node, inherited, visited):
+    """Walk the page tree without letting qpdf normalize it.
+
+    Yields each page with the attributes it inherits from its ancestors.
+    """
+    if node.objgen in visited:
+        raise ValueError("Loop in page tree")
+    visited.add(node.objgen)
+    if '/Kids' not in node:
+        yield node, inherited
+        return
+    inherited = dict(inherited)
+    for key in ('/Resources', '/MediaBox', '/CropBox', '/Rotate'):
+        if key in node:
+            inherited[key] = node[key]
+    for kid in node.Kids:
+        yield from _page_tree_leaves(kid, inherited, visited)
+
+
+def _startxref(f):
+    """Offset and kind of the last cross-reference section of a file"""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 1024))
+    tail = f.read()
+    n = tail.rfind(b'startxref')
+    if n < 0:
+        return None, None
+    offset = int(tail[n + 9:].split()[0])
+    f.seek(offset)
+    return offset, f.read(4) == b'xref'
+
+
+def _incremental_update(filename, pages):
+    """Rewrite the page tree of filename as an incremental update.
+
+    Only the root of the page tree and the pages which were not its direct kids
+    are appended, with a new cross-reference section.
+    Returns False if the file cannot be updated this way.
+    """
+    pdf = pikepdf.open(filename)
+    with pdf, open(filename, 'r+b') as f:
+        if len(pdf.get_warnings()) > 0 or pdf.is_encrypted:
+            # Damaged files have unreliable cross-reference offsets
+            return False
+        prev, classic = _startxref(f)
+        if prev is None:
+            return False
+        root = pdf.Root.Pages
+        try:
+            leaves = list(_page_tree_leaves(root, {}, set()))
+        except (ValueError, AttributeError):
+            return False
+        if root.get('/Count') != len(leaves) or any(kid.objgen[0] == 0 for kid, _i in leaves):
+            return False
+        objects = {}
+        kids = []
+        for page in pages:
+            kid, inherited = leaves[page.npage - 1]
+            parent = kid.get('/Parent')
+            if parent is None or parent.objgen != root.objgen:
+                for key, value in inherited.items():
+                    if key not in kid:
+                        kid[key] = value
+                kid.Parent = root
+                objects[kid.objgen] = kid
+            kids.append(kid)
+        root.Kids = pikepdf.Array(kids)
+        root.Count = len(kids)
+        if any(obj.objgen[0] >= pdf.trailer.Size for obj in pdf.objects):
+            # qpdf created objects while normalizing the page tree
+            return False
+        objects[root.objgen] = root
+        trailer = pikepdf.Dictionary(Size=pdf.trailer.Size, Root=pdf.trailer.Root, Prev=prev)
+        for key in ('/Info', '/ID'):
+            if key in pdf.trailer:
+                trailer[key] = pdf.trailer[key]
+
+        size = f.seek(0, os.SEEK_END)
+        try:
+            f.write(b'\n')
+            offsets = {}
+            for objgen, obj in sorted(objects.items()):
+                offsets[objgen] = f.tell()
+                f.write(b'%d %d obj\n' % objgen + obj.unparse(resolved=True) + b'\nendobj\n')
+            startxref = f.tell()
+            if classic:
+                f.write(b'xref\n')
+                for (num, gen), offset in sorted(offsets.items()):
+                    f.write(b'%d 1\n%010d %05d n\r\n' % (num, offset, gen))
+                f.write(b'trailer\n' + trailer.unparse() + b'\n')
+            else:
+                # Sections following a cross-reference stream must be streams too
+                num = int(trailer.Size)
+                offsets[(num, 0)] = startxref
+                width = max(4, math.ceil(startxref.bit_length() / 8))
+                data = b''.join(b'\x01' + offset.to_bytes(width, 'big') + gen.to_bytes(2, 'big')
+                                for (_num, gen), offset in sorted(offsets.items()))
+                trailer.Type = pikepdf.Name.XRef
+                trailer.Size = num + 1
+                trailer.W = [1, width, 2]
+                trailer.Index = [i for n, _gen in sorted(offsets) for i in (n, 1)]
+                trailer.Length = len(data)
+                f.write(b'%d 0 obj\n' % num + trailer.unparse() + b'\nstream\n' + data +
+                        b'\nendstream\nendobj\n')
+            f.write(b'startxref\n%d\n%%%%EOF\n' % startxref)
+        except BaseException:
+            f.truncate(size)
+            raise
+    return True
+
+
+def export(files, pages, mdata, files_out, config, quit_flag, test_mode=False, sources=None,
+           profile='DEFAULT', **kwargs):
+    if (sources is not None and config.incremental_save() and len(mdata) == 0
+            and not config.deduplicate_resources() and profile == 'DEFAULT'
+            and config.save_options() == dict(linearize=False, object_streams='preserve',
+                                              compression_level=-1)):
+        nfile = _source_to_update(files, sources, pages, files_out)
+        if nfile is not None and _incremental_update(sources[nfile][0], pages):
+            return
+    dedup = config.deduplicate_resources()
+    save_options = config.save_options()
+    chunk_size = config.chunk_size()
+    if 0 < chunk_size < len(pages) and isinstance(files_out[0], str) and not test_mode:
+        export_doc_chunked(files, pages, mdata, files_out, quit_flag, chunk_size, dedup, profile,
+                           save_options)
+        return
     pdf_input = [
         pikepdf.open(copyname, password=password) for copyname, password in files
     ]
     if config.start_with_empty():
-        export_doc(pdf_input, pages, mdata, files_out, quit_flag, test_mode)
+        export_doc(pdf_input, pages, mdata, files_out, quit_flag, test_mode, dedup, profile,
+                   save_options)
     else:
-        export_doc_job(pdf_input, files, pages, mdata, files_out, quit_flag, test_mode)
+        export_doc_job(pdf_input, files, pages, mdata, files_out, quit_flag, test_mode, dedup,
+                       profile, save_options)
 
 
 def num_pages(filepath):
@@ -508,144 +1016,3 @@ def num_pages(filepath):
     npages = len(pdf.pages)
     pdf.close()
     return npages
-
-
-class PrintSettingsWidget(Gtk.Grid):
-    def __init__(self, scale_mode, auto_rotate):
-        super().__init__(margin=0, row_spacing=6, column_spacing=12, border_width=12)
-        lbl = Gtk.Label(_("Scale mode:"), margin=0)
-        self.combo = Gtk.ComboBoxText(margin=0)
-        self.combo.append("NONE", _("None"))
-        self.combo.append("PRINTABLE", _("Fit to Printable Area"))
-        self.combo.append("FULL", _("Fit to Full Page"))
-        self.combo.set_active_id(scale_mode)
-        self.cb = Gtk.CheckButton(label=_("Auto Rotate"), margin=0)
-        self.cb.set_active(auto_rotate)
-        self.attach(lbl, 0, 1, 1, 1)
-        self.attach(self.combo, 1, 1, 2, 1)
-        self.attach(self.cb, 0, 2, 2, 1)
-        self.show_all()
-
-    def get_scale_mode(self):
-        return self.combo.get_active_id()
-
-    def get_auto_rotate(self):
-        return self.cb.get_active()
-
-
-def get_in_memory_poppler_doc(pages, pdfqueue):
-    """Export the pages with pikepdf then create a in memory poppler doc"""
-    nfiles = set()
-    for p in pages:
-        nfiles.add(p.nfile)
-        for lp in p.layerpages:
-            nfiles.add(lp.nfile)
-    pdf_input = [None] * len(pdfqueue)
-    for nfile in nfiles:
-        pdf = pdfqueue[nfile - 1]
-        pdf_input[nfile - 1] = pikepdf.open(pdf.copyname, password=pdf.password)
-    buf = io.BytesIO()
-    export_doc(pdf_input, pages, {}, [buf], None)
-    return Poppler.Document.new_from_data(buf.getvalue()), buf
-
-
-# Adapted from https://stackoverflow.com/questions/28325525/python-gtk-printoperation-print-a-pdf
-class PrintOperation(Gtk.PrintOperation):
-    MESSAGE=_("Printing…")
-    def __init__(self, app):
-        super().__init__(embed_page_setup=True, support_selection=True)
-        self.app = app
-        self.connect("create-custom-widget", self.create_custom_widget)
-        self.connect("custom-widget-apply", self.custom_widget_apply)
-        self.connect("request-page-setup", self.request_page_setup)
-        self.connect("begin-print", self.begin_print, None)
-        self.connect("end-print", self.end_print, None)
-        self.connect("draw-page", self.draw_page, None)
-        self.connect("preview", self.preview, None)
-        self.message = self.MESSAGE
-        self.scale_mode = self.app.config.scale_mode()
-        self.auto_rotate = self.app.config.auto_rotate()
-        self.set_use_full_page(self.scale_mode != 'PRINTABLE')
-        self.snums = [p.get_indices() for p in reversed(app.iconview.get_selected_items())]
-        self.set_has_selection(len(self.snums) > 0)
-
-    def create_custom_widget(self, operation):
-        self.set_custom_tab_label(_("Page Handling"))
-        return PrintSettingsWidget(self.scale_mode, self.auto_rotate)
-
-    def custom_widget_apply(self, operation, widget):
-        self.scale_mode = widget.get_scale_mode()
-        self.auto_rotate = widget.get_auto_rotate()
-        self.set_use_full_page(self.scale_mode != 'PRINTABLE')
-
-    def request_page_setup(self, operation, print_ctx, page_num, setup):
-        if self.auto_rotate:
-            w_page = self.pages[page_num].width_in_points()
-            h_page = self.pages[page_num].height_in_points()
-            if w_page >= h_page:
-                setup.set_orientation(Gtk.PageOrientation.LANDSCAPE)
-            else:
-                setup.set_orientation(Gtk.PageOrientation.PORTRAIT)
-
-    def preview(self, operation, preview_op, print_ctx, parent, user_data):
-        self.message = _("Rendering Preview…")
-
-    def begin_print(self, operation, print_ctx, print_data):
-        self.app.set_export_state(True, self.message)
-        psel = self.get_print_settings().get_print_pages() == Gtk.PrintPages.SELECTION
-        nums = self.snums if psel else range(len(self.app.model))
-        self.pages = [self.app.model[n][0].duplicate(incl_thumbnail=False) for n in nums]
-        self.app.apply_hide_margins_on_pages(self.pages)
-        self.set_n_pages(len(self.pages))
-
-        self.temp_doc, self.buf = get_in_memory_poppler_doc(self.pages, self.app.pdfqueue)
-
-    def end_print(self, operation, print_ctx, print_data):
-        self.app.set_export_state(False)
-        self.message = self.MESSAGE
-        self.app.config.set_scale_mode(self.scale_mode)
-        self.app.config.set_auto_rotate(self.auto_rotate)
-
-    def draw_page(self, operation, print_ctx, page_num, print_data):
-        cairo_ctx = print_ctx.get_cairo_context()
-        # Poppler context is always 72 dpi
-        cairo_ctx.scale(print_ctx.get_dpi_x() / 72, print_ctx.get_dpi_y() / 72)
-        if page_num >= len(self.app.model):
-            return
-        setup = print_ctx.get_page_setup()
-        if self.scale_mode == 'PRINTABLE':
-            w_paper = setup.get_page_width(Gtk.Unit.POINTS)
-            h_paper = setup.get_page_height(Gtk.Unit.POINTS)
-        else:
-            w_paper = setup.get_paper_width(Gtk.Unit.POINTS)
-            h_paper = setup.get_paper_height(Gtk.Unit.POINTS)
-        w_page = self.pages[page_num].width_in_points()
-        h_page = self.pages[page_num].height_in_points()
-        print_scale = self.get_print_settings().get_scale() / 100
-        scale = 1
-        if self.scale_mode != 'NONE':
-            w_scale = w_paper / (w_page * print_scale)
-            h_scale = h_paper / (h_page * print_scale)
-            scale = min(w_scale, h_scale)
-            cairo_ctx.scale(scale, scale)
-
-        # Center page on paper
-        dx = w_paper / (scale * print_scale) - w_page
-        dy = h_paper / (scale * print_scale) - h_page
-        cairo_ctx.translate(dx / 2, dy / 2)
-
-        page = self.temp_doc.get_page(page_num)
-        page.render_for_printing(cairo_ctx)
-
-    def run(self):
-        result = super().run(Gtk.PrintOperationAction.PRINT_DIALOG, self.app.window)
-        if result == Gtk.PrintOperationResult.ERROR:
-            dialog = Gtk.MessageDialog(
-                self.app.window,
-                0,
-                Gtk.MessageType.ERROR,
-                Gtk.ButtonsType.CLOSE,
-                self.get_error(),
-            )
-            dialog.run()
-            dialog.destroy()
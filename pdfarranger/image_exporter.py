@@ -15,29 +15,64 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-import cairo
 import img2pdf
+import os
 import pikepdf
+import queue
+import threading
 import traceback
 
-from math import pi
+from concurrent.futures import ThreadPoolExecutor
+from pikepdf import Dictionary, Name
 from gi.repository import Gtk, GObject
 
-from .core import PDFRenderer, _img_to_pdf
+from .core import PDFRenderer
 from .exporter import _set_meta
 from .metadata import merge
 
 
+def _png_idat(data):
+    """The zlib compressed image data of a non interlaced png file.
+
+    It is a valid FlateDecode stream with png predictors (see img2pdf).
+    """
+    idat = []
+    pos = 8  # png signature
+    while pos < len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        if data[pos + 4:pos + 8] == b'IDAT':
+            idat.append(data[pos + 8:pos + 8 + length])
+        pos += length + 12  # length, type and crc
+    return b''.join(idat)
+
+
+#: Horizontal resolution of fax images
+FAX_DPI_X = 204
+#: Vertical resolution of fax images
+FAX_DPI_Y = {'FINE': 196, 'STANDARD': 98}
+
+
 class ImageExporter:
-    """Export to png, jpg or rasterized pdf (with png or jpg images)"""
+    """Export to png, jpg, rasterized pdf (with png or jpg images) or multi-page fax tiff
+
+    Pages are rendered by a PDFRenderer thread, then converted and encoded by a
+    pool of threads (Pillow releases the GIL while encoding). A writer thread
+    collects the encoded pages in order to build the rasterized pdf or the tiff.
+    """
     def __init__(self, files, pages, metadata, files_out, config, pdfqueue, exportmode, export_msg):
         self.files = files
         self.model = Gtk.ListStore(GObject.TYPE_PYOBJECT)
+        if exportmode == 'SELECTED_TO_TIFF_G4':
+            # Render at the horizontal resolution, the height is resampled when encoding
+            self.ppi = FAX_DPI_X
+            self.fax_dpi = FAX_DPI_X, FAX_DPI_Y[config.tiff_resolution()]
+            self.dither = config.tiff_dither()
+        else:
+            self.ppi = config.image_ppi()
         for page in pages:
-            page.zoom = config.image_ppi() / 72  # pdf is 72 dpi
+            page.zoom = self.ppi / 72  # pdf is 72 dpi
             page.resample = -1
             self.model.append([page])
-        self.ppi = config.image_ppi()
         self.optimize = config.optimize()
         self.greyscale = config.greyscale()
         self.metadata = metadata
@@ -46,13 +81,26 @@ class ImageExporter:
         self.exportmode = exportmode
         self.export_msg = export_msg
         self.rendering_thread = None
+        self.nworkers = os.cpu_count() or 1
+        self.encoders = None
+        #: (future, page size) of the pages being encoded, in page order
+        self.encoded = queue.Queue()
+        self.writer_thread = None
+        self.exitcode = 0
         if exportmode in ['SELECTED_TO_PDF_PNG', 'SELECTED_TO_PDF_JPG']:
             self.pdf_out = pikepdf.Pdf.new()
+        self.tiff_out = None
         self.is_saving = True
 
     def start(self):
+        self.encoders = ThreadPoolExecutor(max_workers=self.nworkers)
+        self.writer_thread = threading.Thread(target=self.write_pages, daemon=True)
+        self.writer_thread.start()
         prange = [0, len(self.model) - 1]
-        self.rendering_thread = PDFRenderer(self.model, self.pdfqueue, prange, 1, max_nqueue=3)
+        # Two pages per encoder so that no encoder waits for the renderer
+        nqueue = 2 * self.nworkers
+        self.rendering_thread = PDFRenderer(self.model, self.pdfqueue, prange, 1, max_nqueue=nqueue,
+                                            for_export=True)
         self.rendering_thread.connect('update_thumbnail', self.create_page)
         self.rendering_thread.start()
 
@@ -61,6 +109,7 @@ class ImageExporter:
             return
         self.rendering_thread.quit = True
         self.rendering_thread.join(timeout)
+        self.encoded.put(None)  # Wake up the writer thread
         self.is_saving = False
 
     def is_alive(self):
@@ -71,65 +120,118 @@ class ImageExporter:
             return
         if thumbnail is None:
             # Rendering has ended
-            if self.exportmode in ['SELECTED_TO_PDF_PNG', 'SELECTED_TO_PDF_JPG']:
-                self.save_pdf()
-            self.is_saving = False
+            self.encoded.put(None)
             return
         path = ref.get_path()
         page = self.model[path][0]
         ind = Gtk.TreePath.get_indices(path)[0]
+        ext = 'png' if self.exportmode in ['SELECTED_TO_PNG', 'SELECTED_TO_PDF_PNG'] else 'jpeg'
+        if self.exportmode in ['SELECTED_TO_PNG', 'SELECTED_TO_JPG']:
+            filename = self.files_out[ind]
+        else:
+            filename = None
+        if self.exportmode == 'SELECTED_TO_TIFF_G4':
+            future = self.encoders.submit(self.bilevel_page, thumbnail)
+        else:
+            future = self.encoders.submit(self.encode_page, thumbnail, ext, filename)
+        self.encoded.put((future, page.size_in_points()))
 
-        w = thumbnail.get_width()
-        h = thumbnail.get_height()
-        w1, h1 = (h, w) if page.angle in [90, 270] else (w, h)
-        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w1, h1)
-        cr = cairo.Context(surface)
-        cr.set_source_rgb(1, 1, 1)
-        cr.rectangle(0, 0, w1, h1)
-        cr.fill()
-
-        if page.angle > 0:
-            cr.translate(w1 / 2, h1 / 2)
-            cr.rotate(page.angle * pi / 180)
-            cr.translate(-w / 2, -h / 2)
-        cr.set_source_surface(thumbnail)
-        cr.paint()
-
-        imgpil = self.surface_to_pil(surface)
+    def encode_page(self, thumbnail, ext, filename):
+        """Convert a rendered page and save it to filename, or to memory if filename is None"""
+        if self.rendering_thread.quit:
+            return None
+        # The renderer already paints on white in the final orientation
+        imgpil = self.surface_to_pil(thumbnail)
         if self.greyscale:
             imgpil = imgpil.convert('L')
+        if filename is not None:
+            imgpil.save(filename, ext, dpi=(self.ppi, self.ppi), optimize=self.optimize)
+            return None
+        imgio = img2pdf.BytesIO()
+        imgpil.save(imgio, ext, dpi=(self.ppi, self.ppi), optimize=self.optimize)
+        return imgio.getvalue(), ext, imgpil.size, imgpil.mode
 
-        ext = 'png' if self.exportmode in ['SELECTED_TO_PNG', 'SELECTED_TO_PDF_PNG'] else 'jpeg'
-        if self.exportmode in ['SELECTED_TO_PNG', 'SELECTED_TO_JPG']:
-            self.save_image(imgpil, ext, self.files_out[ind])
-        else:
-            self.add_to_pdf(imgpil, ext, page.size_in_points())
-        self.rendering_thread.nqueue -= 1
+    def bilevel_page(self, thumbnail):
+        """Convert a rendered page to a black & white image at fax resolution"""
+        if self.rendering_thread.quit:
+            return None
+        imgpil = self.surface_to_pil(thumbnail).convert('L')
+        xdpi, ydpi = self.fax_dpi
+        if ydpi != xdpi:
+            height = max(1, round(imgpil.height * ydpi / xdpi))
+            imgpil = imgpil.resize((imgpil.width, height), img2pdf.Image.LANCZOS)
+        dither = img2pdf.Image.FLOYDSTEINBERG if self.dither else img2pdf.Image.NONE
+        return imgpil.convert('1', dither=dither)
+
+    def write_pages(self):
+        """Writer thread: wait for the encoded pages in order, then save the pdf"""
+        while True:
+            item = self.encoded.get()
+            if item is None:
+                break
+            future, page_size = item
+            try:
+                image = future.result()
+            except Exception as e:
+                self.exception_handler(e)
+                break
+            finally:
+                self.rendering_thread.dequeue()
+            if image is None:
+                continue
+            if self.exportmode == 'SELECTED_TO_TIFF_G4':
+                if not self.add_to_tiff(image):
+                    break
+            else:
+                self.add_to_pdf(*image, page_size)
+        self.encoders.shutdown(wait=False)
+        if self.tiff_out is not None:
+            self.tiff_out.close()
+        if self.rendering_thread.quit:
+            return
+        if self.exportmode in ['SELECTED_TO_PDF_PNG', 'SELECTED_TO_PDF_JPG']:
+            self.save_pdf()
+        self.is_saving = False
 
     @staticmethod
     def surface_to_pil(surface):
+        """Unpack a RGB24 surface to a Pillow image, straight from the surface buffer"""
         size = (surface.get_width(), surface.get_height())
         stride = surface.get_stride()
+        surface.flush()
         with surface.get_data() as memory:
-            return img2pdf.Image.frombuffer('RGB', size, memory.tobytes(), 'raw', 'BGRX', stride)
-
-    def save_image(self, imgpil, ext, filename):
-        try:
-            imgpil.save(filename, ext, dpi=(self.ppi, self.ppi), optimize=self.optimize)
-        except OSError as e:
-            self.exception_handler(e)
+            return img2pdf.Image.frombuffer('RGB', size, memory, 'raw', 'BGRX', stride, 1)
 
-    def add_to_pdf(self, imgpil, ext, page_size):
-        imgio = img2pdf.BytesIO()
+    def add_to_pdf(self, data, ext, size, mode, page_size):
+        """Add a page showing an encoded png or jpeg image, embedded without decoding it"""
+        colors = 1 if mode == 'L' else 3
+        if ext == 'jpeg':
+            image = self.pdf_out.make_stream(data, Filter=Name.DCTDecode)
+        else:
+            parms = Dictionary(Predictor=15, Colors=colors, BitsPerComponent=8, Columns=size[0])
+            image = self.pdf_out.make_stream(_png_idat(data), Filter=Name.FlateDecode,
+                                             DecodeParms=parms)
+        image.Type = Name.XObject
+        image.Subtype = Name.Image
+        image.Width, image.Height = size
+        image.ColorSpace = Name.DeviceGray if colors == 1 else Name.DeviceRGB
+        image.BitsPerComponent = 8
+        w, h = page_size
+        page = self.pdf_out.add_blank_page(page_size=page_size)
+        page.Resources = Dictionary(XObject=Dictionary(Im0=image))
+        page.Contents = self.pdf_out.make_stream(f'q {w:.4f} 0 0 {h:.4f} 0 0 cm /Im0 Do Q'.encode())
+
+    def add_to_tiff(self, image):
+        """Append a page to the output tiff, written frame by frame"""
         try:
-            imgpil.save(imgio, ext, dpi=(self.ppi, self.ppi), optimize=self.optimize)
+            if self.tiff_out is None:
+                self.tiff_out = img2pdf.TiffImagePlugin.AppendingTiffWriter(self.files_out[0], True)
+            image.save(self.tiff_out, 'TIFF', compression='group4', dpi=self.fax_dpi)
+            self.tiff_out.newFrame()
         except OSError as e:
             self.exception_handler(e)
-            return
-        imgio.seek(0)
-        pdf = _img_to_pdf([imgio], tmp_dir=None, page_size=page_size)
-        src = pikepdf.Pdf.open(pdf)
-        self.pdf_out.pages.extend(src.pages)
+            return False
+        return True
 
     def save_pdf(self):
         m = merge(self.metadata, self.files)
@@ -142,4 +244,5 @@ class ImageExporter:
     def exception_handler(self, e):
         print(traceback.format_exc())
         self.export_msg.put([e, Gtk.MessageType.ERROR])
+        self.exitcode = 1
         self.join()
@@ -23,10 +23,6 @@ import json
 import traceback
 from datetime import datetime
 from dateutil import parser
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
-from gi.repository import Pango
 _ = gettext.gettext
 
 # The producer property can be overridden by pikepdf
@@ -176,6 +172,7 @@ class _EditedEventHandler(object):
 
     @staticmethod
     def _parse_date(string, parent):
+        from gi.repository import Gtk
         try:
             date = parser.parse(string)
             return datetime.isoformat(date) # ISO-8601 formatted date
@@ -210,6 +207,8 @@ def edit(metadata, pdffiles, parent):
     :param pdffiles: A list of PDF from witch to take the initial meta data
     :param parent: The parent window
     """
+    # Gtk is only imported by the dialogs, the exporter uses this module without it
+    from gi.repository import Gtk, Pango
     dialog = Gtk.Dialog(title=_('Edit properties'),
                         parent=parent,
                         flags=Gtk.DialogFlags.MODAL,
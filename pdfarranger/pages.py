@@ -0,0 +1,392 @@
+# Copyright (C) 2020 pdfarranger contributors
+#
+# pdfarranger is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Description of the arranged pages. Neither Gtk nor Poppler are needed here."""
+
+import copy
+from typing import NamedTuple, Union
+
+
+Numeric = Union[float, int]
+
+
+class Sides(NamedTuple):
+    left: Numeric = 0
+    right: Numeric = 0
+    top: Numeric = 0
+    bottom: Numeric = 0
+
+    def __neg__(self) -> "Sides":
+        """
+        Pointwise unary minus
+
+        Example:
+
+        >>> -Sides(9, 3, 12, 6)
+        Sides(left=-9, right=-3, top=-12, bottom=-6)
+        """
+        return Sides(*(-self[i] for i in range(4)))
+
+    def __add__(self, other: Union["Sides", Numeric]) -> "Sides":
+        """
+        Pointwise addition
+
+        Example:
+
+        >>> Sides(9, 3, 12, 6) + Sides(1, 2, 3, 4)
+        Sides(left=10, right=5, top=15, bottom=10)
+        >>> Sides(9, 3, 12, 6) + 1
+        Sides(left=10, right=4, top=13, bottom=7)
+        """
+        if isinstance(other, Sides):
+            return Sides(*(self[i] + other[i] for i in range(4)))
+        else:
+            return Sides(*(self[i] + other for i in range(4)))
+
+    def __sub__(self, other: Union["Sides", Numeric]) -> "Sides":
+        """
+        Pointwise subtraction
+
+        Example:
+
+        >>> Sides(9, 3, 12, 6) - Sides(1, 2, 3, 4)
+        Sides(left=8, right=1, top=9, bottom=2)
+        >>> Sides(9, 3, 12, 6) - 3
+        Sides(left=6, right=0, top=9, bottom=3)
+        """
+        if isinstance(other, Sides):
+            return Sides(*(self[i] - other[i] for i in range(4)))
+        else:
+            return Sides(*(self[i] -+ other for i in range(4)))
+
+    def __mul__(self, other: Union["Sides", Numeric]) -> "Sides":
+        """
+        Pointwise multiplication
+
+        Example:
+
+        >>> Sides(9, 3, 12, 6) * Sides(1, 2, 3, 4)
+        Sides(left=9, right=6, top=36, bottom=24)
+        >>> Sides(9, 3, 12, 6) * 3
+        Sides(left=27, right=9, top=36, bottom=18)
+        """
+        if isinstance(other, Sides):
+            return Sides(*(self[i] * other[i] for i in range(4)))
+        else:
+            return Sides(*(self[i] * other for i in range(4)))
+
+    def __truediv__(self, other: Union["Sides", Numeric]) -> "Sides":
+        """
+        Pointwise division
+
+        Example:
+
+        >>> Sides(9, 3, 12, 6) / Sides(1, 2, 3, 4)
+        Sides(left=9.0, right=1.5, top=4.0, bottom=1.5)
+        >>> Sides(9, 3, 12, 6) / 3
+        Sides(left=3.0, right=1.0, top=4.0, bottom=2.0)
+        """
+        if isinstance(other, Sides):
+            return Sides(*(self[i] / other[i] for i in range(4)))
+        else:
+            return Sides(*(self[i] / other for i in range(4)))
+
+    def rotated(self, times: int) -> "Sides":
+        """
+        Rotate 90 degrees counter-clockwise 'times' times
+
+        Examples:
+
+        >>> Sides(9,3,12,6).rotated(1)
+        Sides(left=12, right=6, top=3, bottom=9)
+        >>> Sides(9,3,12,6).rotated(-3) == Sides(9,3,12,6).rotated(1)
+        True
+        """
+        perm = (0, 2, 1, 3)
+        return Sides(*(self[perm[(x + times) % 4]] for x in perm))
+
+    def max(self, other: "Sides") -> "Sides":
+        """
+        Pointwise max
+
+        Example:
+
+        >>> Sides(1, 2, 3, 4).max(Sides(4, 3, 2, 1))
+        Sides(left=4, right=3, top=3, bottom=4)
+        """
+        return Sides(*(max(self[i], other[i]) for i in range(4)))
+
+
+class Dims(NamedTuple):
+    width: Numeric
+    height: Numeric
+
+    def __neg__(self) -> "Dims":
+        """
+        Pointwise unary minus
+
+        Example:
+
+        >>> -Dims(612, 792)
+        Dims(width=-612, height=-792)
+        """
+        return Dims(*(-self[i] for i in range(2)))
+
+    def __add__(self, other: Union["Dims", Numeric]) -> "Dims":
+        """
+        Pointwise addition
+
+        Example:
+
+        >>> Dims(612, 792) + Dims(612, 792)
+        Dims(width=1224, height=1584)
+        >>> Dims(612, 792) + 100
+        Dims(width=712, height=892)
+        """
+        if isinstance(other, Dims):
+            return Dims(*(self[i] + other[i] for i in range(2)))
+        else:
+            return Dims(*(self[i] + other for i in range(2)))
+
+    def __sub__(self, other: Union["Dims", Numeric]) -> "Dims":
+        """
+        Pointwise subtraction
+
+        Example:
+
+        >>> Dims(612, 792) - Dims(306, 396)
+        Dims(width=306, height=396)
+        >>> Dims(612, 792) - 100
+        Dims(width=512, height=692)
+        """
+        if isinstance(other, Dims):
+            return Dims(*(self[i] - other[i] for i in range(2)))
+        else:
+            return Dims(*(self[i] -+ other for i in range(2)))
+
+    def __mul__(self, other: Union["Dims", Numeric]) -> "Dims":
+        """
+        Pointwise multiplication
+
+        Example:
+
+        >>> Dims(612, 792) * Dims(0.5, 0.25)
+        Dims(width=306.0, height=198.0)
+        >>> Dims(612, 792) * 2
+        Dims(width=1224, height=1584)
+        """
+        if isinstance(other, Dims):
+            return Dims(*(self[i] * other[i] for i in range(2)))
+        else:
+            return Dims(*(self[i] * other for i in range(2)))
+
+    def __truediv__(self, other: Union["Dims", Numeric]) -> "Dims":
+        """
+        Pointwise division
+
+        Example:
+
+        >>> Dims(612, 792) / Dims(2, 4)
+        Dims(width=306.0, height=198.0)
+        >>> Dims(612, 792) / 2
+        Dims(width=306.0, height=396.0)
+        """
+        if isinstance(other, Dims):
+            return Dims(*(self[i] / other[i] for i in range(2)))
+        else:
+            return Dims(*(self[i] / other for i in range(2)))
+
+    def flipped(self) -> "Dims":
+        """Swap height and width"""
+        return Dims(self.height, self.width)
+
+    def scaled(self, factor: float) -> "Dims":
+        """Scale by factor"""
+        return Dims(self.width * factor, self.height * factor)
+
+    def int_scaled(self, factor: float) -> "Dims":
+        """Scale by factor and round to nearest int"""
+        return Dims(int(self.width * factor + 0.5), int(self.height * factor + 0.5))
+
+    def cropped(self, crop: Sides) -> "Dims":
+        """Crop using crop array"""
+        return Dims(self.width * (1 - crop.left - crop.right), self.height * (1 - crop.top - crop.bottom))
+
+
+class BasePage:
+    """Common base class for Page and LayerPage"""
+
+    def __init__(self, nfile, npage, copyname, angle, scale, crop: Sides, size_orig: Dims):
+        self.nfile = nfile
+        """The ID (from 1 to n) of the PDF file owning the page"""
+        self.npage = npage
+        """The ID (from 1 to n) of the page in its owner PDF document"""
+        self.copyname = copyname
+        """Filepath to the temporary stored file"""
+        self.angle = angle
+        self.scale = scale
+        self.crop = crop
+        """Left, right, top, bottom crop"""
+        self.size_orig = size_orig
+        """Width and height of the original page"""
+        self.size = size_orig if angle in [0, 180] else size_orig.flipped()
+        """Width and height"""
+
+    def width_in_points(self) -> Numeric:
+        """Return the page width in PDF points."""
+        return self.size_in_points().width
+
+    def height_in_points(self) -> Numeric:
+        """Return the page height in PDF points."""
+        return self.size_in_points().height
+
+    def size_in_points(self) -> Dims:
+        """Return the page size in PDF points."""
+        return self.size.scaled(self.scale).cropped(self.crop)
+
+    def size_in_mm(self) -> Dims:
+        """Return the page size in mm."""
+        return self.size_in_points() * 25.4 / 72
+
+    def width_in_pixel(self):
+        return self.size_in_pixel().width
+
+    def height_in_pixel(self):
+        return self.size_in_pixel().height
+
+    def size_in_pixel(self):
+        return self.size_in_points().int_scaled(self.zoom)
+
+    @staticmethod
+    def rotate_times(angle: int) -> int:
+        """Convert an angle in degree to a number of 90° rotation (integer)."""
+        return round((-angle  / 90) % 4)
+
+
+class Page(BasePage):
+    def __init__(self, nfile, npage, zoom, copyname, angle, scale, crop: Sides, hide: Sides, size_orig: Dims, description, layerpages):
+        super().__init__(nfile, npage, copyname, angle, scale, Sides(*crop), size_orig)
+        self.zoom = zoom
+        self.hide = Sides(*hide)
+        """Left, right, top, bottom hide"""
+        self.thumbnail = None
+        self.resample = -1
+        self.preview = None
+        """A low resolution thumbnail"""
+        self.description = description
+        """The text under the thumbnail"""
+        self.layerpages = list(layerpages)
+        self.find_rectangles = None
+
+    def __repr__(self):
+        return (f"Page({self.nfile}, {self.npage}, {self.zoom}, '{self.copyname}', "
+                f"{self.angle}, {self.scale}, {self.crop}, {self.hide}, "
+                f"{self.size_orig}, '{self.description}', {self.layerpages})")
+
+    def rotate(self, angle: int):
+        rt = self.rotate_times(angle)
+        if rt == 0:
+            return False
+        self.crop = self.crop.rotated(rt)
+        self.hide = self.hide.rotated(rt)
+        self.angle = (self.angle + int(angle)) % 360
+        self.size = self.size_orig if self.angle in [0, 180] else self.size_orig.flipped()
+        for lp in self.layerpages:
+            lp.rotate(rt)
+        return True
+
+    def unmodified(self):
+        u = (self.angle == 0 and self.crop == Sides() and self.hide == Sides() and
+             self.scale == 1 and len(self.layerpages) == 0)
+        return u
+
+    def serialize(self):
+        """Convert to string for copy/past operations."""
+        lpdata = [lp.serialize() for lp in self.layerpages]
+        ts = [self.copyname, self.npage, self.description, self.angle, self.scale]
+        ts += list(self.crop) + list(self.hide) + list(lpdata)
+        return "///".join([str(v) for v in ts])
+
+    def duplicate(self, incl_thumbnail=True):
+        r = copy.copy(self)
+        r.find_rectangles = None
+        r.layerpages = [lp.duplicate() for lp in r.layerpages]
+        if incl_thumbnail == False:
+            del r.thumbnail  # to save ram
+            r.thumbnail = None
+            r.preview = None
+        return r
+
+    def split(self, vcrops, hcrops):
+        """Split this page into a grid and return all but the top-left page."""
+        newpages = []
+        left, right, top, bottom = self.crop
+        # If the page is cropped, adjust the new crop for the visible part of the page.
+        hscale = 1 - (left + right)
+        vscale = 1 - (top + bottom)
+        vcrops = [(l * hscale, r * hscale) for (l, r) in vcrops]
+        hcrops = [ (t * vscale, b * vscale) for (t, b) in hcrops]
+
+        for (t, b) in reversed(hcrops):
+            topcrop = top + t
+            row_height = b - t
+            bottomcrop = 1 - (topcrop + row_height)
+            for (l, r) in reversed(vcrops):
+                leftcrop = left + l
+                col_width = r - l
+                rightcrop = 1 - (leftcrop + col_width)
+                crop = Sides(leftcrop, rightcrop, topcrop, bottomcrop)
+                if l == 0.0 and t == 0.0:
+                    # Update the original page
+                    self.crop = crop
+                else:
+                    # Create a new cropped page
+                    new = self.duplicate()
+                    new.crop = crop
+                    newpages.append(new)
+        return newpages
+
+
+class LayerPage(BasePage):
+    """Page added as overlay or underlay on a Page."""
+
+    def __init__(self, nfile, npage, copyname, angle, scale, crop, offset, laypos, size_orig: Dims):
+        super().__init__(nfile, npage, copyname, angle, scale, Sides(*crop), size_orig)
+        self.offset = Sides(*offset)
+        """Left, right, top, bottom offset from dest page edges"""
+        self.laypos = laypos
+        """OVERLAY or UNDERLAY"""
+
+    def __repr__(self):
+        return (f"LayerPage({self.nfile}, {self.npage}, '{self.copyname}', {self.angle}, "
+                f"{self.scale}, {self.crop}, {self.offset}, '{self.laypos}', {self.size_orig})")
+
+    def rotate(self, times: int):
+        if times != 0:
+            self.crop = self.crop.rotated(times)
+            self.offset = self.offset.rotated(times)
+            self.angle = (self.angle - 90 * times) % 360
+            self.size = self.size if times % 2 == 0 else self.size.flipped()
+
+    def serialize(self):
+        """Convert to string for copy/past operations."""
+        ts = [self.copyname, self.npage, self.angle, self.scale, self.laypos]
+        ts += list(self.crop) + list(self.offset)
+        return "///".join([str(v) for v in ts])
+
+    def duplicate(self):
+        r = copy.copy(self)
+        return r
@@ -22,7 +22,7 @@ import locale
 from math import pi
 
 from .core import Sides, Dims, PDFRenderer
-from .exporter import get_in_memory_poppler_doc
+from .printing import PAGE_CACHE_SIZE, get_in_memory_poppler_doc
 
 _ = gettext.gettext
 
@@ -380,11 +380,20 @@ def white_borders(model, selection, pdfqueue):
     # Create the temporary document without crops. They will be applied later
     for p in pages:
         p.crop = Sides()
-    poppler_doc, _buf = get_in_memory_poppler_doc(pages, pdfqueue)
+
+    batched = len(pages) > PAGE_CACHE_SIZE
+    if batched:
+        # Too many pages to cache them, export them at once
+        poppler_doc, _buf = get_in_memory_poppler_doc(pages, pdfqueue)
 
     crop = []
-    for i, orig_crop in enumerate(orig_crops):
-        poppler_page = poppler_doc.get_page(i)
+    for i, (p, orig_crop) in enumerate(zip(pages, orig_crops)):
+        if batched:
+            poppler_page = poppler_doc.get_page(i)
+        else:
+            # One document per page so that the exports are cached and reused
+            poppler_doc, _buf = get_in_memory_poppler_doc([p], pdfqueue)
+            poppler_page = poppler_doc.get_page(0)
 
         # Always render pages at 72 dpi whatever the zoom or scale of the page
         w, h = poppler_page.get_size()
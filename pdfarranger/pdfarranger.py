@@ -35,6 +35,7 @@ import locale  # for multilanguage support
 import gettext
 import gc
 import subprocess
+import struct
 import pikepdf
 import hashlib
 from urllib.request import url2pathname
@@ -173,7 +174,9 @@ gettext.textdomain(DOMAIN)
 _ = gettext.gettext
 
 from . import undo
+from . import transfer
 from . import exporter
+from . import printing
 from . import metadata
 from . import pageutils
 from . import splitter
@@ -516,6 +519,7 @@ class PdfArranger(Gtk.Application):
             ("find_prev", self.searchbar_widget.find_prev),
             ("find_next", self.searchbar_widget.find_next),
             ("find_all", self.searchbar_widget.find_all),
+            ("find_select", self.searchbar_widget.find_select),
         ]
         self.window.add_action_entries(self.actions)
 
@@ -542,10 +546,9 @@ class PdfArranger(Gtk.Application):
             adder = PageAdder(self)
             if len(selection) > 0:
                 adder.move(Gtk.TreeRowReference.new(model, selection[-1]), False)
-            file, _ = exporter.get_blank_doc(adder, self.pdfqueue, self.tmp_dir, page_size)
+            file = exporter.add_blank_pages(adder, self.pdfqueue, self.tmp_dir, page_size)
             if file is None:
                 return
-            adder.addpages(file)
             adder.commit(select_added=False, add_to_undomanager=True)
 
     def generate_booklet(self, _action, _option, _unknown):
@@ -559,7 +562,7 @@ class PdfArranger(Gtk.Application):
             return
         self.undomanager.commit("generate booklet")
 
-        data = self.copy_pages(add_hash=False, deserialize=True)
+        data = self.copy_pages(deserialize=True)
         self.clear_selected(add_to_undomanager=False)
         self.iconview.unselect_all()
 
@@ -571,10 +574,9 @@ class PdfArranger(Gtk.Application):
         before = ndpage < len(self.model)
         ref = Gtk.TreeRowReference.new(self.model, selection[-1]) if before else None
         w, h = max_size
-        a = adder, self.pdfqueue, self.tmp_dir, (w * 2, h), nbooklet
-        file = exporter.get_blank_doc(*a)[0]
         adder.move(ref, before)
-        adder.addpages(file)
+        a = adder, self.pdfqueue, self.tmp_dir, (w * 2, h), nbooklet
+        exporter.add_blank_pages(*a)
         adder.commit(select_added=True, add_to_undomanager=False)
         self.update_iconview_geometry()
         self.update_max_zoom_level()
@@ -726,11 +728,12 @@ class PdfArranger(Gtk.Application):
 
     def on_action_preferences(self, _action, _option, _unknown):
         handy_available = True if Handy else False
-        self.config.preferences_dialog(self.window, handy_available)
+        self.config.preferences_dialog(self.window, handy_available, self.undomanager.usage())
+        self.undomanager.compact()
         self.set_color_scheme()
 
     def on_action_print(self, _action, _option, _unknown):
-        exporter.PrintOperation(self).run()
+        printing.PrintOperation(self).run()
 
     @staticmethod
     def __create_filters(file_type_list):
@@ -763,6 +766,15 @@ class PdfArranger(Gtk.Application):
                 if os.name != 'nt':
                     f.add_mime_type('image/jpeg')
             filter_list.append(f_jpeg)
+        if 'tiff' in file_type_list:
+            f_tiff = Gtk.FileFilter()
+            f_tiff.set_name(_('TIFF images'))
+            for f in [f_tiff, f_supported]:
+                f.add_pattern('*.tif')
+                f.add_pattern('*.tiff')
+                if os.name != 'nt':
+                    f.add_mime_type('image/tiff')
+            filter_list.append(f_tiff)
         if 'all' in file_type_list:
             f = Gtk.FileFilter()
             f.set_name(_('All files'))
@@ -873,7 +885,7 @@ class PdfArranger(Gtk.Application):
 
         searchbar = self.uiXML.get_object('searchbar')
         args = (self.window, self.iconview, self.pdfqueue,
-                self.show_find_results, self.clear_find_results)
+                self.show_find_results, self.clear_find_results, self.select_pages)
         self.searchbar_widget = SearchBarWidget(*args)
         searchbar.pack_start(self.searchbar_widget, True, True, 0)
 
@@ -1304,10 +1316,13 @@ class PdfArranger(Gtk.Application):
         self.clear_data()
 
     def clear_data(self):
+        self.searchbar_widget.stop_indexing()
         self.iconview.unselect_all()
         with self.render_lock():
             self.model.clear()
         self.pdfqueue.clear()
+        printing.clear_in_memory_cache()
+        self.searchbar_widget.clear_cache()
         self.metadata = {}
         self.undomanager.clear()
         self.set_save_file(None)
@@ -1348,6 +1363,7 @@ class PdfArranger(Gtk.Application):
             self.rendering_thread.quit = True
             self.rendering_thread.join()
             self.rendering_thread.pdfqueue = []
+        self.searchbar_widget.shutdown()
 
         if self.export_process:
             self.export_process.join(timeout=2)
@@ -1361,12 +1377,14 @@ class PdfArranger(Gtk.Application):
 
         # Release Poppler.Document instances to unlock all temporary files
         self.pdfqueue.clear()
+        self.undomanager.clear()
         gc.collect()
         if self.config.save_window_geometry():
             self.config.set_window_size(self.window.get_size())
             self.config.set_maximized(self.window.is_maximized())
             self.config.set_zoom_level(round(self.zoom_level))
         self.config.save()
+        printing.clear_in_memory_cache()
         if os.path.isdir(self.tmp_dir):
             shutil.rmtree(self.tmp_dir)
         self.quit()
@@ -1415,6 +1433,8 @@ class PdfArranger(Gtk.Application):
                     ext = '.png'
                 elif exportmode == 'SELECTED_TO_JPG':
                     ext = '.jpg'
+                elif exportmode == 'SELECTED_TO_TIFF_G4':
+                    ext = '.tif'
                 else:
                     ext = '.pdf'
                 f += ext
@@ -1425,13 +1445,43 @@ class PdfArranger(Gtk.Application):
             filter_list = self.__create_filters(['png', 'all'])
         elif exportmode == 'SELECTED_TO_JPG':
             filter_list = self.__create_filters(['jpeg', 'all'])
+        elif exportmode == 'SELECTED_TO_TIFF_G4':
+            filter_list = self.__create_filters(['tiff', 'all'])
         else:
             filter_list = self.__create_filters(['pdf', 'all'])
         for f in filter_list[1:]:
             chooser.add_filter(f)
+        pdf_modes = ['ALL_TO_SINGLE', 'ALL_TO_MULTIPLE', 'SELECTED_TO_SINGLE', 'SELECTED_TO_MULTIPLE']
+        has_profile = exportmode in pdf_modes and hasattr(chooser, 'add_choice')
+        if has_profile:
+            chooser.add_choice('profile', _("Profile:"), ['DEFAULT', 'FAX'],
+                               [_("Standard"), _("Fax (black & white, 200 dpi)")])
+            chooser.set_choice('profile', 'DEFAULT')
+            chooser.add_choice('compression', _("Compression:"),
+                               ['DEFAULT', 'COMPACT', 'MAXIMUM'],
+                               [_("Standard"), _("Object streams"),
+                                _("Object streams and maximum compression")])
+            chooser.set_choice('compression', self.config.compression())
+            chooser.add_choice('linearize', _("Fast web view"), None, None)
+            chooser.set_choice('linearize', str(self.config.linearize()).lower())
+        has_fax_choices = exportmode == 'SELECTED_TO_TIFF_G4' and hasattr(chooser, 'add_choice')
+        if has_fax_choices:
+            chooser.add_choice('resolution', _("Resolution:"), ['FINE', 'STANDARD'],
+                               [_("Fine (204×196 dpi)"), _("Standard (204×98 dpi)")])
+            chooser.set_choice('resolution', self.config.tiff_resolution())
+            chooser.add_choice('dither', _("Dithering"), None, None)
+            chooser.set_choice('dither', str(self.config.tiff_dither()).lower())
 
         response = chooser.run()
         file_out = chooser.get_filename()
+        # The profile only applies to this export, not to the next saves
+        profile = chooser.get_choice('profile') if has_profile else 'DEFAULT'
+        if has_profile and response == Gtk.ResponseType.ACCEPT:
+            self.config.set_compression(chooser.get_choice('compression'))
+            self.config.set_linearize(chooser.get_choice('linearize') == 'true')
+        if has_fax_choices and response == Gtk.ResponseType.ACCEPT:
+            self.config.set_tiff_resolution(chooser.get_choice('resolution'))
+            self.config.set_tiff_dither(chooser.get_choice('dither') == 'true')
         chooser.destroy()
         if response == Gtk.ResponseType.ACCEPT:
             root, ext = os.path.splitext(file_out)
@@ -1439,7 +1489,10 @@ class PdfArranger(Gtk.Application):
                 file_out += '.png'
             elif exportmode == 'SELECTED_TO_JPG' and ext.lower() not in ['.jpg', '.jpeg']:
                 file_out += '.jpg'
-            elif exportmode not in ['SELECTED_TO_PNG', 'SELECTED_TO_JPG'] and ext.lower() != '.pdf':
+            elif exportmode == 'SELECTED_TO_TIFF_G4' and ext.lower() not in ['.tif', '.tiff']:
+                file_out += '.tif'
+            elif (exportmode not in ['SELECTED_TO_PNG', 'SELECTED_TO_JPG', 'SELECTED_TO_TIFF_G4']
+                  and ext.lower() != '.pdf'):
                 file_out += '.pdf'
             files_out = [file_out]
             if exportmode in [
@@ -1455,7 +1508,7 @@ class PdfArranger(Gtk.Application):
                         replace = self.confirm_dialog(msg, _("Replace"))
                         if not replace:
                             return
-            self.save(exportmode, files_out)
+            self.save(exportmode, files_out, profile)
         else:
             self.post_action = None
 
@@ -1537,7 +1590,7 @@ class PdfArranger(Gtk.Application):
     def on_action_save_as(self, _action, _param, _unknown):
         self.choose_export_pdf_name('ALL_TO_SINGLE')
 
-    def save(self, exportmode, files_out):
+    def save(self, exportmode, files_out, profile='DEFAULT'):
         """Saves to the specified file."""
         if exportmode in ['ALL_TO_SINGLE', 'ALL_TO_MULTIPLE']:
             pages = [row[0].duplicate(incl_thumbnail=False) for row in self.model]
@@ -1558,12 +1611,14 @@ class PdfArranger(Gtk.Application):
         export_msg = multiprocessing.Queue()
         args = files, pages, self.metadata, files_out, self.config
         if exportmode in [
-            'SELECTED_TO_PNG', 'SELECTED_TO_JPG', 'SELECTED_TO_PDF_PNG', 'SELECTED_TO_PDF_JPG'
+            'SELECTED_TO_PNG', 'SELECTED_TO_JPG', 'SELECTED_TO_PDF_PNG', 'SELECTED_TO_PDF_JPG',
+            'SELECTED_TO_TIFF_G4'
             ]:
             self.export_process = ImageExporter(*args, self.pdfqueue, exportmode, export_msg)
         else:
             args = *args, self.quit_flag
-            kwargs = dict(export_msg=export_msg)
+            sources = [(pdf.filename, pdf.stat) for pdf in self.pdfqueue]
+            kwargs = dict(export_msg=export_msg, sources=sources, profile=profile)
             self.export_process = multiprocessing.Process(target=exporter.export_process,
                                                           args=args, kwargs=kwargs)
         self.export_process.start()
@@ -1651,9 +1706,10 @@ class PdfArranger(Gtk.Application):
                        4: 'SELECTED_TO_PNG',
                        5: 'SELECTED_TO_JPG',
                        6: 'SELECTED_TO_PDF_PNG',
-                       7: 'SELECTED_TO_PDF_JPG'}
+                       7: 'SELECTED_TO_PDF_JPG',
+                       8: 'SELECTED_TO_TIFF_G4'}
         exportmode = exportmodes[mode.get_int32()]
-        if ImageExporter is None and mode.get_int32() in [4, 5, 6, 7]:
+        if ImageExporter is None and mode.get_int32() in [4, 5, 6, 7, 8]:
             msg = _("Img2pdf support missing.")
             self.error_message_dialog(msg)
             return
@@ -1717,26 +1773,20 @@ class PdfArranger(Gtk.Application):
         self.iconview.scroll_to_path(path, False, 0, 0)
         sw_hadj.set_value(sw_hpos)
 
-    def copy_pages(self, add_hash=True, deserialize=False):
-        """Collect data from selected pages"""
+    def copy_pages(self, deserialize=False):
+        """Collect data from selected pages.
+
+        Return them packed with transfer.pack, or in deserialized form.
+        """
 
         model = self.iconview.get_model()
         selection = self.iconview.get_selected_items()
         selection.sort(key=lambda x: x.get_indices()[0])
 
-        data = []
-        for path in selection:
-            it = model.get_iter(path)
-            data.append(model.get_value(it, 0).serialize())
-
-        if data:
-            if deserialize:
-                return self.deserialize(data)
-            data = '\n;\n'.join(data)
-            if add_hash:
-                h = hashlib.sha256(data.encode('utf-8')).hexdigest()
-                data = h + '\n' + data
-        return data
+        data = [transfer.page_data(model[path][0]) for path in selection]
+        if deserialize:
+            return data
+        return transfer.pack(data)
 
     def paste_pages(self, data, before, ref_to, select_added):
         """Paste pages to iconview"""
@@ -1806,14 +1856,14 @@ class PdfArranger(Gtk.Application):
     def on_action_cut(self, _action, _param, _unknown):
         """Cut selected pages to clipboard."""
         data = self.copy_pages()
-        self.clipboard.set_text('pdfarranger-clipboard\n' + data, -1)
+        self.clipboard.set_text(transfer.to_text(data), -1)
         self.clear_selected()
         self.window.lookup_action("paste").set_enabled(True)
 
     def on_action_copy(self, _action, _param, _unknown):
         """Copy selected pages to clipboard."""
         data = self.copy_pages()
-        self.clipboard.set_text('pdfarranger-clipboard\n' + data, -1)
+        self.clipboard.set_text(transfer.to_text(data), -1)
         self.window.lookup_action("paste").set_enabled(True)
 
     def on_action_paste(self, _action, mode, _unknown):
@@ -1988,7 +2038,18 @@ class PdfArranger(Gtk.Application):
                 data = ''
 
             data_is_filepaths = False
-            if data.startswith('pdfarranger-clipboard\n'):
+            if data.startswith(transfer.CLIPBOARD_ID):
+                try:
+                    data = transfer.from_text(data)
+                except ValueError:
+                    data = []
+                if not all(os.path.isfile(d[0]) for d in data):
+                    data = []
+                if len(data) == 0:
+                    message = _("Pasted data not valid. Aborting paste.")
+                    self.error_message_dialog(message)
+            elif data.startswith('pdfarranger-clipboard\n'):
+                # Text format of older versions
                 data = data.replace('pdfarranger-clipboard\n', '', 1)
                 try:
                     copy_hash = data[:data.index('\n')]
@@ -2242,17 +2303,14 @@ class PdfArranger(Gtk.Application):
             self.target_is_intern = True
             selection = self.iconview.get_selected_items()
             selection.sort(key=lambda x: x.get_indices()[0])
-            data = []
-            for path in selection:
-                data.append(str(path[0]))
-            if data:
-                data = '\n;\n'.join(data)
+            rows = [path.get_indices()[0] for path in selection]
+            data = struct.pack(f'<{len(rows)}I', *rows)
         elif target == 'MODEL_ROW_EXTERN':
             self.target_is_intern = False
-            data = self.copy_pages(add_hash=False)
+            data = self.copy_pages()
         else:
             return
-        selection_data.set(selection_data.get_target(), 8, data.encode())
+        selection_data.set(selection_data.get_target(), 8, data)
 
     def iv_dnd_received_data(self, iconview, context, _x, _y,
                              selection_data, _target_id, etime):
@@ -2262,7 +2320,6 @@ class PdfArranger(Gtk.Application):
         data = selection_data.get_data()
         if not data:
             return
-        data = data.decode().split('\n;\n')
         if self.drag_path and len(model) > 0:
             ref_to = Gtk.TreeRowReference.new(model, self.drag_path)
         else:
@@ -2276,7 +2333,8 @@ class PdfArranger(Gtk.Application):
             move = context.get_selected_action() & Gdk.DragAction.MOVE
             self.undomanager.commit("Move" if move else "Copy")
             self.set_unsaved(True)
-            data.sort(key=int, reverse=not before)
+            data = list(struct.unpack(f'<{len(data) // 4}I', data))
+            data.sort(reverse=not before)
             ref_from_list = [Gtk.TreeRowReference.new(model, Gtk.TreePath(p))
                              for p in data]
             iter_to = self.model.get_iter(ref_to.get_path())
@@ -2297,7 +2355,14 @@ class PdfArranger(Gtk.Application):
             GObject.idle_add(self.render)
 
         elif target == 'MODEL_ROW_EXTERN':
-            data = self.deserialize(data)
+            if data.startswith(transfer.MAGIC):
+                try:
+                    data = transfer.unpack(data)
+                except ValueError:
+                    return
+            else:
+                # Text format of older versions
+                data = self.deserialize(data.decode().split('\n;\n'))
             changed = self.paste_pages(data, before, ref_to, select_added=True)
             if changed and context.get_selected_action() & Gdk.DragAction.MOVE:
                 context.finish(True, True, etime)
@@ -2877,7 +2942,7 @@ class PdfArranger(Gtk.Application):
         selection = self.iconview.get_selected_items()
         if not self.is_paste_layer_available(selection):
             return
-        data = self.copy_pages(add_hash=False, deserialize=True)
+        data = self.copy_pages(deserialize=True)
         sizes, max_size, equal = self.get_size_info(selection)
         r = pageutils.MergePagesDialog(self.window, max_size, equal).run_get()
         if r is None:
@@ -2894,12 +2959,10 @@ class PdfArranger(Gtk.Application):
         wdpage, hdpage = size[0] * cols, size[1] * rows
         ndpages = -(len(data) // -(cols * rows))
         adder = PageAdder(self)
+        adder.move(ref, before)
         a = adder, self.pdfqueue, self.tmp_dir, (wdpage, hdpage), ndpages
-        file, _ = exporter.get_blank_doc(*a)
-        if file is None:
+        if exporter.add_blank_pages(*a) is None:
             return
-        adder.move(ref, before)
-        adder.addpages(file)
         adder.commit(select_added=True, add_to_undomanager=False)
 
         nlpage = 0
@@ -3015,9 +3078,9 @@ class PdfArranger(Gtk.Application):
                 continue
             ref = Gtk.TreeRowReference.new(self.model, path)
             adder.move(ref, before=False)
-            adder.addpages(file)
+            adder.addpages(file, 1)
             adder.commit(select_added=False, add_to_undomanager=False)
-            data = self.deserialize([self.model[path][0].serialize()])
+            data = [transfer.page_data(self.model[path][0])]
             with self.render_lock():
                 self.model.remove(self.model.get_iter(path))
             self.paste_as_layer(data, path, 'OVERLAY', (0.5, 0.5))
@@ -3311,6 +3374,24 @@ class PdfArranger(Gtk.Application):
         self.scroll_to_path2(path)
         self.iv_selection_changed()
 
+    def select_pages(self, npages):
+        """Replace the selection by the pages npages (indices in the model) at once."""
+        # Gtk.IconView has no bulk selection, so start from the closest of
+        # select_all and unselect_all and toggle as few pages as possible.
+        npages = set(npages)
+        if len(npages) > len(self.model) // 2:
+            self.iconview.select_all()
+            for npage, row in enumerate(self.model):
+                if npage not in npages:
+                    self.iconview.unselect_path(row.path)
+        else:
+            self.iconview.unselect_all()
+            for npage in npages:
+                self.iconview.select_path(Gtk.TreePath.new_from_indices([npage]))
+        if len(npages) > 0:
+            self.scroll_to_path2(Gtk.TreePath.new_from_indices([min(npages)]))
+        self.iv_selection_changed()
+
     def clear_find_results(self, unselect_all):
         """Clear all rectangles around found text."""
         for row in self.model:
@@ -0,0 +1,207 @@
+# Copyright (C) 2008-2017 Konstantinos Poulios, 2018-2019 Jerome Robert
+#
+# pdfarranger is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Printing and in memory rendering of the arranged pages"""
+
+import io
+import gettext
+import threading
+import pikepdf
+import gi
+from gi.repository import Gtk
+gi.require_version("Poppler", "0.18")
+from gi.repository import Poppler
+
+from .cache import LRUCache
+from .exporter import export_doc
+
+_ = gettext.gettext
+
+
+class PrintSettingsWidget(Gtk.Grid):
+    def __init__(self, scale_mode, auto_rotate):
+        super().__init__(margin=0, row_spacing=6, column_spacing=12, border_width=12)
+        lbl = Gtk.Label(_("Scale mode:"), margin=0)
+        self.combo = Gtk.ComboBoxText(margin=0)
+        self.combo.append("NONE", _("None"))
+        self.combo.append("PRINTABLE", _("Fit to Printable Area"))
+        self.combo.append("FULL", _("Fit to Full Page"))
+        self.combo.set_active_id(scale_mode)
+        self.cb = Gtk.CheckButton(label=_("Auto Rotate"), margin=0)
+        self.cb.set_active(auto_rotate)
+        self.attach(lbl, 0, 1, 1, 1)
+        self.attach(self.combo, 1, 1, 2, 1)
+        self.attach(self.cb, 0, 2, 2, 1)
+        self.show_all()
+
+    def get_scale_mode(self):
+        return self.combo.get_active_id()
+
+    def get_auto_rotate(self):
+        return self.cb.get_active()
+
+
+# The temporary copies of the input files never change, so the opened pikepdf
+# documents can be shared by all the in memory exports. Single exported pages
+# are also kept, keyed by their serialized state, as search and white border
+# detection ask for the same pages again and again.
+INPUT_CACHE_SIZE = 16
+PAGE_CACHE_SIZE = 32
+_cache_lock = threading.Lock()
+_input_cache = LRUCache(INPUT_CACHE_SIZE, on_evict=lambda pdf: pdf.close())
+_page_cache = LRUCache(PAGE_CACHE_SIZE)
+
+
+def clear_in_memory_cache():
+    """Close the cached input files, e.g. before removing the temporary copies"""
+    with _cache_lock:
+        _page_cache.clear()
+        _input_cache.clear()
+
+
+def _open_input(pdf, keep):
+    key = pdf.copyname, pdf.password
+    r = _input_cache.get(key)
+    if r is None:
+        r = pikepdf.open(pdf.copyname, password=pdf.password)
+        _input_cache.put(key, r, keep)
+    return r
+
+
+def get_in_memory_poppler_doc(pages, pdfqueue):
+    """Export the pages with pikepdf then create a in memory poppler doc"""
+    key = tuple(p.serialize() for p in pages) if len(pages) == 1 else None
+    with _cache_lock:
+        if key is not None and key in _page_cache:
+            return _page_cache.get(key)
+        nfiles = set()
+        for p in pages:
+            nfiles.add(p.nfile)
+            for lp in p.layerpages:
+                nfiles.add(lp.nfile)
+        # The files used by this export may be more than the cache size but must stay open
+        keep = {(pdfqueue[nfile - 1].copyname, pdfqueue[nfile - 1].password) for nfile in nfiles}
+        pdf_input = [None] * len(pdfqueue)
+        for nfile in nfiles:
+            pdf_input[nfile - 1] = _open_input(pdfqueue[nfile - 1], keep)
+        buf = io.BytesIO()
+        export_doc(pdf_input, pages, {}, [buf], None)
+        r = Poppler.Document.new_from_data(buf.getvalue()), buf
+        if key is not None:
+            _page_cache.put(key, r)
+    return r
+
+
+# Adapted from https://stackoverflow.com/questions/28325525/python-gtk-printoperation-print-a-pdf
+class PrintOperation(Gtk.PrintOperation):
+    MESSAGE=_("Printing…")
+    def __init__(self, app):
+        super().__init__(embed_page_setup=True, support_selection=True)
+        self.app = app
+        self.connect("create-custom-widget", self.create_custom_widget)
+        self.connect("custom-widget-apply", self.custom_widget_apply)
+        self.connect("request-page-setup", self.request_page_setup)
+        self.connect("begin-print", self.begin_print, None)
+        self.connect("end-print", self.end_print, None)
+        self.connect("draw-page", self.draw_page, None)
+        self.connect("preview", self.preview, None)
+        self.message = self.MESSAGE
+        self.scale_mode = self.app.config.scale_mode()
+        self.auto_rotate = self.app.config.auto_rotate()
+        self.set_use_full_page(self.scale_mode != 'PRINTABLE')
+        self.snums = [p.get_indices() for p in reversed(app.iconview.get_selected_items())]
+        self.set_has_selection(len(self.snums) > 0)
+
+    def create_custom_widget(self, operation):
+        self.set_custom_tab_label(_("Page Handling"))
+        return PrintSettingsWidget(self.scale_mode, self.auto_rotate)
+
+    def custom_widget_apply(self, operation, widget):
+        self.scale_mode = widget.get_scale_mode()
+        self.auto_rotate = widget.get_auto_rotate()
+        self.set_use_full_page(self.scale_mode != 'PRINTABLE')
+
+    def request_page_setup(self, operation, print_ctx, page_num, setup):
+        if self.auto_rotate:
+            w_page = self.pages[page_num].width_in_points()
+            h_page = self.pages[page_num].height_in_points()
+            if w_page >= h_page:
+                setup.set_orientation(Gtk.PageOrientation.LANDSCAPE)
+            else:
+                setup.set_orientation(Gtk.PageOrientation.PORTRAIT)
+
+    def preview(self, operation, preview_op, print_ctx, parent, user_data):
+        self.message = _("Rendering Preview…")
+
+    def begin_print(self, operation, print_ctx, print_data):
+        self.app.set_export_state(True, self.message)
+        psel = self.get_print_settings().get_print_pages() == Gtk.PrintPages.SELECTION
+        nums = self.snums if psel else range(len(self.app.model))
+        self.pages = [self.app.model[n][0].duplicate(incl_thumbnail=False) for n in nums]
+        self.app.apply_hide_margins_on_pages(self.pages)
+        self.set_n_pages(len(self.pages))
+
+        self.temp_doc, self.buf = get_in_memory_poppler_doc(self.pages, self.app.pdfqueue)
+
+    def end_print(self, operation, print_ctx, print_data):
+        self.app.set_export_state(False)
+        self.message = self.MESSAGE
+        self.app.config.set_scale_mode(self.scale_mode)
+        self.app.config.set_auto_rotate(self.auto_rotate)
+
+    def draw_page(self, operation, print_ctx, page_num, print_data):
+        cairo_ctx = print_ctx.get_cairo_context()
+        # Poppler context is always 72 dpi
+        cairo_ctx.scale(print_ctx.get_dpi_x() / 72, print_ctx.get_dpi_y() / 72)
+        if page_num >= len(self.app.model):
+            return
+        setup = print_ctx.get_page_setup()
+        if self.scale_mode == 'PRINTABLE':
+            w_paper = setup.get_page_width(Gtk.Unit.POINTS)
+            h_paper = setup.get_page_height(Gtk.Unit.POINTS)
+        else:
+            w_paper = setup.get_paper_width(Gtk.Unit.POINTS)
+            h_paper = setup.get_paper_height(Gtk.Unit.POINTS)
+        w_page = self.pages[page_num].width_in_points()
+        h_page = self.pages[page_num].height_in_points()
+        print_scale = self.get_print_settings().get_scale() / 100
+        scale = 1
+        if self.scale_mode != 'NONE':
+            w_scale = w_paper / (w_page * print_scale)
+            h_scale = h_paper / (h_page * print_scale)
+            scale = min(w_scale, h_scale)
+            cairo_ctx.scale(scale, scale)
+
+        # Center page on paper
+        dx = w_paper / (scale * print_scale) - w_page
+        dy = h_paper / (scale * print_scale) - h_page
+        cairo_ctx.translate(dx / 2, dy / 2)
+
+        page = self.temp_doc.get_page(page_num)
+        page.render_for_printing(cairo_ctx)
+
+    def run(self):
+        result = super().run(Gtk.PrintOperationAction.PRINT_DIALOG, self.app.window)
+        if result == Gtk.PrintOperationResult.ERROR:
+            dialog = Gtk.MessageDialog(
+                self.app.window,
+                0,
+                Gtk.MessageType.ERROR,
+                Gtk.ButtonsType.CLOSE,
+                self.get_error(),
+            )
+            dialog.run()
+            dialog.destroy()
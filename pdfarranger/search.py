@@ -14,18 +14,146 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 import gettext
+import os
+import re
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from .core import Sides
-from .exporter import get_in_memory_poppler_doc
+from .cache import LRUCache
+from .textindex import Query, layer_rectangles, span_rectangles
 
 _ = gettext.gettext
 
+#: Number of (page, query) search results kept in memory
+RESULT_CACHE_SIZE = 256
+
+
+def page_text(pdfdoc, npage):
+    """The text of a page (from 0), extracted once and kept in the text index of pdfdoc"""
+    text = pdfdoc.text_index.get(npage)
+    if text is None:
+        with pdfdoc.render_lock:
+            text = pdfdoc.document.get_page(npage).get_text() or ""
+        pdfdoc.text_index.set(npage, text)
+    return text
+
+
+def find_in_pdfdoc(pdfdoc, npage, query):
+    """Rectangles around the occurrences of query (a Query) in a page of pdfdoc.
+
+    Poppler is only used to get the character boxes of the pages which match.
+    """
+    ptext = page_text(pdfdoc, npage)
+    spans = query.spans(ptext)
+    if len(spans) == 0:
+        return []
+    with pdfdoc.render_lock:
+        page = pdfdoc.document.get_page(npage)
+        _ok, layout = page.get_text_layout()
+        height = page.get_size()[1]
+    return span_rectangles(ptext, layout, spans, height)
+
+
+class TextIndexer(threading.Thread):
+    """Extract the text of all the pages of pdfqueue in background"""
+
+    def __init__(self, pdfqueue):
+        super().__init__(daemon=True)
+        self.pdfqueue = pdfqueue
+        self.quit = False
+
+    def run(self):
+        for pdfdoc in list(self.pdfqueue):
+            for npage in pdfdoc.text_index.missing():
+                if self.quit:
+                    return
+                page_text(pdfdoc, npage)
+
+
+class SearchJob:
+    """Search pages in a thread pool and stream the results to the main thread in page order.
+
+    pages is a list of (page number, Page) and search_page(page) returns the rectangles
+    found in a page. The callbacks are called in the main thread: on_result(page number,
+    rectangles) for each page with results, on_progress(fraction) and on_done().
+    """
+
+    def __init__(self, pages, search_page, on_result, on_progress, on_done):
+        self.pages = pages
+        self.search_page = search_page
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.on_done = on_done
+        #: The cancellation token, checked by the workers before each page
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.results = {}
+        self.next = 0
+        self.flush_pending = False
+
+    def chunks(self, nworkers):
+        """Split the pages in ranges of consecutive pages of the same document"""
+        size = max(8, len(self.pages) // (4 * nworkers))
+        chunk = []
+        for i, (_npage, page) in enumerate(self.pages):
+            if len(chunk) > 0 and (len(chunk) == size or page.nfile != self.pages[i - 1][1].nfile):
+                yield chunk
+                chunk = []
+            chunk.append(i)
+        if len(chunk) > 0:
+            yield chunk
+
+    def start(self, executor, nworkers):
+        for chunk in self.chunks(nworkers):
+            executor.submit(self.run_chunk, chunk)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run_chunk(self, chunk):
+        for i in chunk:
+            if self.cancelled.is_set():
+                return
+            try:
+                rectangles = self.search_page(self.pages[i][1])
+            except Exception:
+                traceback.print_exc()
+                rectangles = []
+            with self.lock:
+                self.results[i] = rectangles
+                schedule = not self.flush_pending
+                self.flush_pending = True
+            if schedule:
+                GLib.idle_add(self.flush)
+
+    def flush(self):
+        """Hand the results which are ready to the callbacks, in page order"""
+        with self.lock:
+            self.flush_pending = False
+            ready = []
+            while self.next in self.results:
+                ready.append((self.next, self.results.pop(self.next)))
+                self.next += 1
+        for i, rectangles in ready:
+            if self.cancelled.is_set():
+                return False
+            if len(rectangles) > 0:
+                self.on_result(self.pages[i][0], rectangles)
+        if self.cancelled.is_set():
+            return False
+        self.on_progress(self.next / max(1, len(self.pages)))
+        if self.next == len(self.pages):
+            self.on_done()
+        return False
+
 
 class SearchBarWidget(Gtk.SearchBar):
     """A widget for searching of text in PDF"""
-    def __init__(self, window, iconview, pdfqueue, show_find_results, clear_find_results):
+    def __init__(self, window, iconview, pdfqueue, show_find_results, clear_find_results,
+                 select_pages):
         super().__init__(show_close_button=True)
         self.button_box = Gtk.Box(homogeneous=True, halign=Gtk.Align.START, margin_start=6)
 
@@ -44,11 +172,17 @@ class SearchBarWidget(Gtk.SearchBar):
         button_all.connect('clicked', self.find_all)
         self.button_box.pack_start(button_all, True, True, 0)
 
+        button_select = Gtk.Button(label=_("Select"))
+        button_select.set_tooltip_text(_("Select Matching Pages"))
+        button_select.connect('clicked', self.find_select)
+        self.button_box.pack_start(button_select, True, True, 0)
+
         self.entry = Gtk.SearchEntry(width_chars=32)
         self.entry.connect('search_changed', self.enable_actions)
         entry_tools = Gtk.Box()
         entry_tools.pack_start(self.entry, True, True, 0)
         entry_tools.pack_start(self.button_box, True, True, 0)
+        entry_tools.pack_start(self.create_options_button(), False, False, 6)
         entry_tools.connect('unmap', self.close)
 
         self.add(entry_tools)
@@ -57,16 +191,98 @@ class SearchBarWidget(Gtk.SearchBar):
         self.iconview = iconview
         self.pdfqueue = pdfqueue
         self.model = self.iconview.get_model()
+        self.model.connect('rows-reordered', lambda *_args: self.cancel())
         self.show_find_results = show_find_results
         self.clear_find_results = clear_find_results
+        self.select_pages = select_pages
         self.text_old = ""
+        self.query_old = None
+        self.mode = 'text'
+        self.match_case = False
+        self.whole_word = False
         self.page = None
         self.npage = 0
         self.rectangles = []
         self.nrect = 0
-        self.event_cnt = 0
+        self.indexer = None
+        self.nworkers = os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.nworkers)
+        self.job = None
+        self.cache = LRUCache(RESULT_CACHE_SIZE)
+        self.cache_lock = threading.Lock()
+
+    def create_options_button(self):
+        """A button showing the search mode and matching options"""
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, margin=6, spacing=3)
+        group = None
+        labels = [('text', _("Text")), ('regex', _("Regular Expression")),
+                  ('terms', _("Any of a List of Terms"))]
+        for mode, label in labels:
+            button = Gtk.RadioButton.new_with_label_from_widget(group, label)
+            button.set_active(mode == self.mode)
+            button.connect('toggled', self.set_mode, mode)
+            box.pack_start(button, False, False, 0)
+            group = button
+        group.set_tooltip_text(_("Terms are separated by commas or semicolons"))
+        box.pack_start(Gtk.Separator(), False, False, 3)
+        match_case = Gtk.CheckButton(label=_("Match Case"))
+        match_case.connect('toggled', self.set_option, 'match_case')
+        box.pack_start(match_case, False, False, 0)
+        whole_word = Gtk.CheckButton(label=_("Whole Words"))
+        whole_word.connect('toggled', self.set_option, 'whole_word')
+        box.pack_start(whole_word, False, False, 0)
+        box.show_all()
+        popover = Gtk.Popover()
+        popover.add(box)
+        button = Gtk.MenuButton(popover=popover)
+        button.add(Gtk.Image.new_from_icon_name('emblem-system-symbolic', Gtk.IconSize.BUTTON))
+        button.set_tooltip_text(_("Search Options"))
+        return button
+
+    def set_mode(self, button, mode):
+        if button.get_active():
+            self.mode = mode
+            self.validate()
+
+    def set_option(self, button, option):
+        setattr(self, option, button.get_active())
+        self.validate()
+
+    def get_query(self):
+        """The query of the entry with the current options, None if it is not valid"""
+        try:
+            return Query(self.entry.get_text(), self.mode, self.match_case, self.whole_word)
+        except re.error:
+            return None
+
+    def validate(self, _widget=None):
+        """Highlight the entry if it is not a valid regular expression"""
+        context = self.entry.get_style_context()
+        if self.get_query() is None:
+            context.add_class('error')
+        else:
+            context.remove_class('error')
+
+    def clear_cache(self):
+        """Forget the search results, to be called when the input files are closed"""
+        with self.cache_lock:
+            self.cache.clear()
+
+    def start_indexing(self):
+        """Extract the text of the documents which have not been indexed yet"""
+        if self.indexer is None or not self.indexer.is_alive():
+            self.indexer = TextIndexer(self.pdfqueue)
+            self.indexer.start()
+
+    def stop_indexing(self):
+        """Stop the text extraction, to be called before the input files are closed"""
+        if self.indexer is not None:
+            self.indexer.quit = True
+            self.indexer.join()
+            self.indexer = None
 
     def reveal(self):
+        self.start_indexing()
         if not self.get_search_mode():
             self.entry.set_text(self.text_old)
             self.entry.grab_focus()
@@ -98,12 +314,16 @@ class SearchBarWidget(Gtk.SearchBar):
         return handled
 
     def enable_actions(self, _widget=None):
+        if not self.entry.get_text():
+            self.cancel()
+        self.validate()
         enable = (self.entry.get_text() and self.get_search_mode() or
                   self.text_old and not self.get_search_mode())
         self.button_box.set_sensitive(enable)
         self.window.lookup_action("find_prev").set_enabled(enable)
         self.window.lookup_action("find_next").set_enabled(enable)
         self.window.lookup_action("find_all").set_enabled(enable)
+        self.window.lookup_action("find_select").set_enabled(enable)
 
     def find(self, _action, _option, _unknown):
         self.reveal()
@@ -115,28 +335,37 @@ class SearchBarWidget(Gtk.SearchBar):
         self.find_sequent(step=1)
 
     def find_all(self, _widget, _option=None, _unknown=None):
-        self.event_cnt += 1
-        event_cnt = self.event_cnt
+        self.cancel()
         if len(self.model) == 0:
             return
         self.reveal()
         self.clear_find_results(unselect_all=True)
-        text = self.entry.get_text()
-        if text == "":
+        query = self.get_query()
+        if self.entry.get_text() == "" or query is None:
             return
-        for npage in range(len(self.model)):
-            rectangles = self.find_text(npage, text)
-            if len(rectangles) > 0:
-                self.show_find_results(npage, rectangles)
-            self.entry.set_progress_fraction((npage + 1) / max(1, len(self.model)))
-            if self.abort(event_cnt):
-                break
-        self.entry.set_progress_fraction(1)
-        self.entry.set_progress_fraction(0)
+        self.start_job(range(len(self.model)), query, self.show_find_results)
+
+    def find_select(self, _widget, _option=None, _unknown=None):
+        """Select all the pages which match the query at once"""
+        self.cancel()
+        if len(self.model) == 0:
+            return
+        self.reveal()
+        self.clear_find_results(unselect_all=False)
+        query = self.get_query()
+        if self.entry.get_text() == "" or query is None:
+            return
+        matching = set()
+
+        def done():
+            self.job_done()
+            self.select_pages(matching)
+
+        self.start_job(range(len(self.model)), query, lambda npage, _r: matching.add(npage),
+                       search_page=self.page_matches, on_done=done)
 
     def find_sequent(self, _widget=None, step=1):
-        self.event_cnt += 1
-        event_cnt = self.event_cnt
+        self.cancel()
         if len(self.model) == 0:
             return
         self.reveal()
@@ -145,66 +374,116 @@ class SearchBarWidget(Gtk.SearchBar):
             self.npage = selection[-1].get_indices()[0]
         self.npage = min(self.npage, len(self.model) - 1)
         self.clear_find_results(unselect_all=True)
-        text = self.entry.get_text()
-        if text == "":
+        query = self.get_query()
+        if self.entry.get_text() == "" or query is None:
             return
-        text_changed = text != self.text_old
+        query_changed = query != self.query_old
         page_changed = self.model[self.npage][0].__repr__() != self.page.__repr__()
-        if text_changed or page_changed:
+        if query_changed or page_changed:
             # Search in current page
-            self.rectangles = self.find_text(self.npage, text)
+            self.rectangles = self.find_text(self.npage, query)
             self.nrect = -1 if step == 1 else len(self.rectangles)
 
         if 0 <= self.nrect + step < len(self.rectangles):
             # Get next rectangle index
             self.nrect += step
-        else:
-            # Continue searching until text is found or all has been searched
-            self.rectangles = []
-            cnt = 0
-            while len(self.rectangles) == 0 and cnt < len(self.model):
-                self.npage = (self.npage + step) % len(self.model)
-                self.rectangles = self.find_text(self.npage, text)
-                cnt += 1
-                self.entry.set_progress_fraction(cnt / max(1, len(self.model)))
-                if self.abort(event_cnt):
-                    break
-            self.nrect = 0 if step == 1 else len(self.rectangles) - 1
-
-        if len(self.rectangles) > 0 and self.event_cnt == event_cnt:
-            rectangle = self.rectangles[self.nrect]
-            self.show_find_results(self.npage, [rectangle])
-        self.entry.set_progress_fraction(1)
+            self.show_find_results(self.npage, [self.rectangles[self.nrect]])
+            return
+
+        def found(npage, rectangles):
+            self.cancel()
+            self.npage = npage
+            self.page = self.model[npage][0].duplicate(incl_thumbnail=False)
+            self.rectangles = rectangles
+            self.nrect = 0 if step == 1 else len(rectangles) - 1
+            self.show_find_results(npage, [rectangles[self.nrect]])
+
+        # Continue searching until text is found or all has been searched
+        n = len(self.model)
+        self.start_job([(self.npage + step * k) % n for k in range(1, n + 1)], query, found)
+
+    def start_job(self, npages, query, on_result, search_page=None, on_done=None):
+        """Search query in the pages npages in background"""
+        search_page = search_page or self.search_page
+        pages = [(npage, self.model[npage][0].duplicate(incl_thumbnail=False)) for npage in npages]
+        # Results are dropped if the page was moved, replaced or modified during the search
+        rows = {npage: self.model[npage][0] for npage in npages}
+        searched = dict(pages)
+
+        def result(npage, rectangles):
+            if npage >= len(self.model):
+                return
+            page = self.model[npage][0]
+            if page is rows[npage] and page.serialize() == searched[npage].serialize():
+                on_result(npage, rectangles)
+
+        self.text_old = query.key[0]
+        self.query_old = query
+        self.job = SearchJob(pages, lambda page: search_page(page, query), result,
+                             self.entry.set_progress_fraction, on_done or self.job_done)
+        self.job.start(self.executor, self.nworkers)
+
+    def job_done(self):
+        self.job = None
         self.entry.set_progress_fraction(0)
 
-    def find_text(self, npage, text):
+    def cancel(self, _widget=None):
+        """Cancel the running search, if any"""
+        if self.job is not None:
+            self.job.cancel()
+            self.job_done()
+
+    def shutdown(self):
+        """Stop the background threads, to be called when the application quits"""
+        self.cancel()
+        self.stop_indexing()
+        self.executor.shutdown(wait=False)
+
+    def find_text(self, npage, query):
         if len(self.model) == 0:
             return []
         npage = min(npage, len(self.model) - 1)
         self.page = self.model[npage][0].duplicate(incl_thumbnail=False)
-        page = self.page.duplicate(incl_thumbnail=False)
-        page.rotate(-page.angle)
-        crop = page.crop
-        if len(page.layerpages) == 0:
-            doc = self.pdfqueue[page.nfile - 1]
-            poppler_page = doc.get_page(page.npage - 1)
-        else:
-            # Page has layers -> for simplicity export and search in exported pdf.
-            # This is slower but easier than recalculating rectangle coordinates.
-            rescale = 1 / page.scale
-            page.scale = 1
-            for lp in page.layerpages:
-                lp.scale *= rescale
-            page.crop = Sides()
-            page.hide = Sides()
-            doc, _buf = get_in_memory_poppler_doc([page], self.pdfqueue)
-            poppler_page = doc.get_page(0)
-        rectangles = poppler_page.find_text(text)
-        rectangles = self.apply_crop(rectangles, poppler_page.get_size(), crop)
-        if text != "":
-            self.text_old = text
+        rectangles = self.search_page(self.page, query)
+        self.text_old = query.key[0]
+        self.query_old = query
         return rectangles
 
+    def search_page(self, page, query):
+        """Find query in a page. May run in a worker thread.
+
+        The results are cached by page serialization, which includes everything
+        which changes the rendering of the page, and query.
+        """
+        key = page.serialize(), query.key
+        with self.cache_lock:
+            rectangles = self.cache.get(key)
+        if rectangles is None:
+            rectangles = self.find_in_page(page, query)
+            with self.cache_lock:
+                self.cache.put(key, rectangles)
+        return list(rectangles)
+
+    def page_matches(self, page, query):
+        """[True] if query is found in page, [] otherwise. May run in a worker thread."""
+        if len(page.layerpages) > 0 or any(page.crop):
+            return [True] if len(self.search_page(page, query)) > 0 else []
+        # Whole page without layers: the text index is enough, no glyph boxes needed
+        ptext = page_text(self.pdfqueue[page.nfile - 1], page.npage - 1)
+        return [True] if len(query.spans(ptext)) > 0 else []
+
+    def find_in_page(self, page, query):
+        page = page.duplicate(incl_thumbnail=False)
+        page.rotate(-page.angle)
+        pdfdoc = self.pdfqueue[page.nfile - 1]
+        rectangles = find_in_pdfdoc(pdfdoc, page.npage - 1, query)
+        # Search the source page of each layer and place the results like the export
+        for lp in page.layerpages:
+            lpdoc = self.pdfqueue[lp.nfile - 1]
+            found = find_in_pdfdoc(lpdoc, lp.npage - 1, query)
+            rectangles += layer_rectangles(found, lp, page.size_orig)
+        return self.apply_crop(rectangles, page.size_orig, page.crop)
+
     def apply_crop(self, rectangles, size, crop):
         for r in rectangles:
             r.x1 -= size[0] * crop.left
@@ -228,13 +507,6 @@ class SearchBarWidget(Gtk.SearchBar):
             del rectangles[num]
         return rectangles
 
-    def abort(self, event_cnt):
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-        closed = not self.get_search_mode()
-        cleared = not self.entry.get_text()
-        old_event = self.event_cnt > event_cnt
-        return closed or cleared or old_event
-
     def close(self, _widget):
+        self.cancel()
         self.clear_find_results(unselect_all=False)
@@ -0,0 +1,249 @@
+# Copyright (C) 2025 pdfarranger contributors
+#
+# pdfarranger is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Search in the text extracted from the pages, without Poppler.
+
+The text of each page is extracted once and kept in the TextIndex of its
+PDFDoc. A search is then a lookup in this text, and the character boxes
+are only needed for the few pages which actually match.
+"""
+
+import re
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+#: Search modes: the query is a text, a regular expression or a list of terms
+MODES = ('text', 'regex', 'terms')
+
+#: Separators of the terms of a term list
+TERM_SEPARATORS = re.compile(r'[,;\n]+')
+
+_WORD = re.compile(r'\w')
+
+
+class Rectangle:
+    """A rectangle in PDF points with the origin at the bottom left, like Poppler.Rectangle"""
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
+    def __init__(self, x1, y1, x2, y2):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+
+    def __repr__(self):
+        return f"Rectangle({self.x1}, {self.y1}, {self.x2}, {self.y2})"
+
+    def __eq__(self, other):
+        return (self.x1, self.y1, self.x2, self.y2) == (other.x1, other.y1, other.x2, other.y2)
+
+
+class Query:
+    """A search query compiled once and matched against the text of many pages.
+
+    In 'text' mode any white space in the query matches any white space in the
+    text, including line breaks. In 'terms' mode the query is a list of terms
+    separated by commas, semicolons or line breaks, and any of them matches.
+    Invalid regular expressions raise re.error.
+
+    >>> Query(r"inv-\\d+", 'regex').spans("INV-12 inv-345 inv-")
+    [(0, 6), (7, 14)]
+    >>> Query("12, 345", 'terms', whole_word=True).spans("12 345 1234")
+    [(0, 2), (3, 6)]
+    >>> Query("Sit", match_case=True).spans("sit Sit")
+    [(4, 7)]
+    """
+
+    def __init__(self, query, mode='text', match_case=False, whole_word=False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown search mode {mode!r}")
+        self.key = query, mode, match_case, whole_word
+        self.match_case = match_case
+        self.whole_word = whole_word
+        self.automaton = None
+        flags = 0 if match_case else re.IGNORECASE
+        if mode == 'regex':
+            pattern = query
+        elif mode == 'terms':
+            terms = {t.strip() for t in TERM_SEPARATORS.split(query)} - {''}
+            # Longest first so that the alternation prefers the longest term
+            terms = sorted(terms, key=lambda t: (-len(t), t))
+            pattern = '|'.join(re.escape(t) for t in terms)
+            if ahocorasick is not None and len(terms) > 0:
+                self.automaton = ahocorasick.Automaton()
+                for t in terms:
+                    t = t if match_case else t.lower()
+                    self.automaton.add_word(t, len(t))
+                self.automaton.make_automaton()
+        else:
+            pattern = r'\s+'.join(re.escape(w) for w in query.split())
+        if pattern == '':
+            self.regex = None
+            return
+        if whole_word:
+            pattern = r'(?<!\w)(?:' + pattern + r')(?!\w)'
+        self.regex = re.compile(pattern, flags)
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def spans(self, text):
+        """Start and end offsets of the non-overlapping occurrences of the query in text"""
+        if self.regex is None:
+            return []
+        if self.automaton is not None:
+            folded = text if self.match_case else text.lower()
+            # Case folding may change the length of some characters
+            if len(folded) == len(text):
+                return self._automaton_spans(text, folded)
+        return [m.span() for m in self.regex.finditer(text) if m.end() > m.start()]
+
+    def _automaton_spans(self, text, folded):
+        """Like the regular expression, leftmost longest occurrences"""
+        spans = []
+        for end, length in self.automaton.iter(folded):
+            start, end = end + 1 - length, end + 1
+            if self.whole_word and not _is_word(text, start, end):
+                continue
+            spans.append((start, end))
+        spans.sort(key=lambda s: (s[0], -s[1]))
+        r = []
+        for start, end in spans:
+            if len(r) == 0 or start >= r[-1][1]:
+                r.append((start, end))
+        return r
+
+
+def _is_word(text, start, end):
+    """True if the characters around text[start:end] are not word characters"""
+    return ((start == 0 or not _WORD.match(text, start - 1)) and
+            (end == len(text) or not _WORD.match(text, end)))
+
+
+def find_spans(text, query):
+    """Start and end offsets of the case insensitive occurrences of query in text.
+
+    Any white space in query matches any white space in text, including line breaks.
+
+    >>> find_spans("Lorem ipsum\\ndolor sit LOREM", "ipsum dolor")
+    [(6, 17)]
+    >>> find_spans("Lorem ipsum\\ndolor sit LOREM", "lorem")
+    [(0, 5), (22, 27)]
+    """
+    return Query(query).spans(text)
+
+
+def span_rectangles(text, layout, spans, height):
+    """Rectangles around the characters of the spans, one per line.
+
+    layout is the list of the boxes of the characters of text, with the origin
+    at the top left (see Poppler.Page.get_text_layout). height is the page height.
+
+    >>> layout = [Rectangle(10 * i, 0, 10 * i + 8, 12) for i in range(4)]
+    >>> layout += [Rectangle(0, 20, 8, 32)]
+    >>> span_rectangles("abc\\nd", layout, [(1, 5)], 100)
+    [Rectangle(10, 88, 28, 100), Rectangle(0, 68, 8, 80)]
+    """
+    rectangles = []
+    for start, end in spans:
+        current = None
+        for n in range(start, min(end, len(layout))):
+            if text[n] == '\n':
+                continue
+            box = layout[n]
+            x1, y1, x2, y2 = box.x1, height - box.y2, box.x2, height - box.y1
+            if current is not None and y1 < current.y2 and y2 > current.y1 and x1 >= current.x1:
+                # Same line
+                current.x2 = max(current.x2, x2)
+                current.y1 = min(current.y1, y1)
+                current.y2 = max(current.y2, y2)
+            else:
+                current = Rectangle(x1, y1, x2, y2)
+                rectangles.append(current)
+    return rectangles
+
+
+def layer_rectangles(rectangles, layerpage, size):
+    """Map rectangles found in the source page of a layer to the page it is laid on.
+
+    The page is not rotated and size is its width and height. The layer is
+    rotated and cropped, then fitted and centered in the area given by its
+    offsets, like the export does with add_overlay or add_underlay. Rectangles
+    which are cropped away are removed.
+
+    >>> from pdfarranger.pages import Dims, LayerPage, Sides
+    >>> lp = LayerPage(1, 1, '', 90, 1, Sides(0.5, 0, 0, 0), Sides(0.5, 0, 0, 0.5), 'OVERLAY',
+    ...                Dims(100, 200))
+    >>> layer_rectangles([Rectangle(10, 20, 30, 40), Rectangle(10, 120, 30, 140)], lp, Dims(200, 200))
+    [Rectangle(120.0, 170.0, 140.0, 190.0)]
+    """
+    w, h = layerpage.size_orig
+    r = []
+    for rect in rectangles:
+        x1, y1, x2, y2 = rect.x1, rect.y1, rect.x2, rect.y2
+        rw, rh = w, h
+        # Clockwise rotation like the /Rotate of the exported layer page
+        for _ in range(layerpage.angle // 90 % 4):
+            x1, y1, x2, y2 = y1, rw - x2, y2, rw - x1
+            rw, rh = rh, rw
+        r.append((x1, y1, x2, y2))
+    if layerpage.angle // 90 % 2 == 1:
+        w, h = h, w
+    left, right, top, bottom = layerpage.crop
+    cw, ch = w * (1 - left - right), h * (1 - top - bottom)
+    if cw <= 0 or ch <= 0:
+        return []
+    offset = layerpage.offset
+    ax1, ay1 = size[0] * offset.left, size[1] * offset.bottom
+    aw = size[0] * (1 - offset.left - offset.right)
+    ah = size[1] * (1 - offset.top - offset.bottom)
+    factor = min(aw / cw, ah / ch)
+    x0 = ax1 + (aw - factor * cw) / 2 - factor * w * left
+    y0 = ay1 + (ah - factor * ch) / 2 - factor * h * bottom
+    rectangles = []
+    for x1, y1, x2, y2 in r:
+        if x2 < w * left or x1 > w * (1 - right) or y2 < h * bottom or y1 > h * (1 - top):
+            continue
+        rectangles.append(Rectangle(x0 + factor * x1, y0 + factor * y1,
+                                    x0 + factor * x2, y0 + factor * y2))
+    return rectangles
+
+
+class TextIndex:
+    """The text of the pages of a document"""
+
+    def __init__(self, npages):
+        self.texts = [None] * npages
+
+    def __len__(self):
+        return len(self.texts)
+
+    def get(self, npage):
+        """The text of the page npage (from 0), None if it has not been extracted yet"""
+        return self.texts[npage]
+
+    def set(self, npage, text):
+        self.texts[npage] = text
+
+    def missing(self):
+        """The pages which have not been extracted yet"""
+        return [n for n, t in enumerate(self.texts) if t is None]
@@ -0,0 +1,136 @@
+# Copyright (C) 2025 pdfarranger contributors
+#
+# pdfarranger is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Binary format of the pages exchanged by copy & paste and drag & drop.
+
+The file names are stored once in a table and each page is a fixed size
+record followed by its description and its layers. The payload is protected
+by a CRC32. The data unpacks to the same tuples as PdfArranger.deserialize
+so the '///' text format can still be read as a fallback.
+"""
+
+import base64
+import binascii
+import struct
+import zlib
+
+#: Magic and version of the binary format
+MAGIC = b'PDFA'
+VERSION = 1
+
+#: Prefix of the clipboard text holding base64 encoded binary data
+CLIPBOARD_ID = 'pdfarranger-clipboard-bin\n'
+
+_HEADER = struct.Struct('<4sHII')  # magic, version, crc32, number of files
+_LENGTH = struct.Struct('<I')
+# file index, page number, angle, scale, crop, hide, number of layers, description length
+_PAGE = struct.Struct('<IIhd4d4dHI')
+# file index, page number, angle, scale, underlay, crop, offset
+_LAYER = struct.Struct('<IIhd?4d4d')
+
+
+def page_data(page):
+    """The data of a page, in the format of PdfArranger.deserialize"""
+    layerdata = [[lp.copyname, lp.npage, lp.angle, lp.scale, lp.laypos, list(lp.crop),
+                  list(lp.offset)] for lp in page.layerpages]
+    return (page.copyname, page.npage, page.description, page.angle, page.scale,
+            list(page.crop), list(page.hide), layerdata)
+
+
+def pack(data):
+    """Pack a list of page data (see page_data) to bytes.
+
+    >>> data = [('a.pdf', 2, 'a\\npage 2', 90, 1.5, [0.1, 0, 0, 0], [0, 0, 0, 0.2],
+    ...          [['b.pdf', 1, 0, 0.5, 'UNDERLAY', [0, 0, 0, 0], [0.25, 0.25, 0, 0]]])]
+    >>> unpack(pack(data)) == data
+    True
+    """
+    files = {}
+    records = []
+    for filename, npage, description, angle, scale, crop, hide, layerdata in data:
+        nfile = files.setdefault(filename, len(files))
+        desc = description.encode('utf-8')
+        records.append(_PAGE.pack(nfile, npage, angle, scale, *crop, *hide,
+                                  len(layerdata), len(desc)))
+        records.append(desc)
+        for lfilename, lnpage, langle, lscale, laypos, lcrop, loffset in layerdata:
+            lfile = files.setdefault(lfilename, len(files))
+            records.append(_LAYER.pack(lfile, lnpage, langle, lscale, laypos == 'UNDERLAY',
+                                       *lcrop, *loffset))
+    table = []
+    for filename in files:
+        name = filename.encode('utf-8')
+        table.append(_LENGTH.pack(len(name)))
+        table.append(name)
+    payload = _LENGTH.pack(len(data)) + b''.join(table) + b''.join(records)
+    return _HEADER.pack(MAGIC, VERSION, zlib.crc32(payload), len(files)) + payload
+
+
+def unpack(buf):
+    """Unpack bytes created by pack. Raise ValueError if they are not valid."""
+    try:
+        magic, version, crc, nfiles = _HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Unknown page data format")
+        if zlib.crc32(memoryview(buf)[_HEADER.size:]) != crc:
+            raise ValueError("Corrupted page data")
+        pos = _HEADER.size
+        npages, = _LENGTH.unpack_from(buf, pos)
+        pos += _LENGTH.size
+        files = []
+        for _ in range(nfiles):
+            length, = _LENGTH.unpack_from(buf, pos)
+            pos += _LENGTH.size
+            files.append(bytes(buf[pos:pos + length]).decode('utf-8'))
+            pos += length
+        data = []
+        for _ in range(npages):
+            r = _PAGE.unpack_from(buf, pos)
+            pos += _PAGE.size
+            nlayers, length = r[12], r[13]
+            description = bytes(buf[pos:pos + length]).decode('utf-8')
+            pos += length
+            layerdata = []
+            for _ in range(nlayers):
+                lr = _LAYER.unpack_from(buf, pos)
+                pos += _LAYER.size
+                laypos = 'UNDERLAY' if lr[4] else 'OVERLAY'
+                layerdata.append([files[lr[0]], lr[1], lr[2], lr[3], laypos,
+                                  list(lr[5:9]), list(lr[9:13])])
+            data.append((files[r[0]], r[1], description, r[2], r[3], list(r[4:8]),
+                         list(r[8:12]), layerdata))
+        return data
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid page data") from e
+
+
+def to_text(buf):
+    """Clipboard text for packed data, the Gtk clipboard only handles text"""
+    return CLIPBOARD_ID + base64.b64encode(zlib.compress(buf, 1)).decode('ascii')
+
+
+def from_text(text):
+    """Unpack the clipboard text created by to_text. Raise ValueError if it is not valid.
+
+    >>> data = [('a.pdf', 1, 'a', 0, 1.0, [0, 0, 0, 0], [0, 0, 0, 0], [])]
+    >>> from_text(to_text(pack(data))) == data
+    True
+    """
+    try:
+        buf = zlib.decompress(base64.b64decode(text[len(CLIPBOARD_ID):], validate=True))
+    except (binascii.Error, zlib.error) as e:
+        raise ValueError("Invalid page data") from e
+    return unpack(buf)
@@ -21,18 +21,110 @@ The memento pattern is simpler than the command pattern.
 Here the memory cost of memento is affordable because we
 only store snapshots of the GtkListStore object, not of
 the whole PDF files.
+
+Snapshots share their pages: a page which did not change since the
+previous snapshot is not copied again. Only the newest snapshot keeps the
+full list of pages, older ones only keep the difference with the next one,
+so the history grows with the size of the edits, not of the document.
+
+The number of steps can be limited. When the history uses more memory than
+allowed, the oldest differences are written to a journal file in the
+temporary directory and read back only when they are undone.
 """
 
-from dataclasses import dataclass
+import os
+import pickle
+import sys
+import weakref
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from typing import Optional
 from .core import Page
 
 
+def diff(new, old):
+    """The operations which transform the list new into the list old.
+
+    Items are compared by identity. Each operation is a (start, end, items)
+    tuple which replaces new[start:end] by items, see patch.
+
+    >>> a, b, c, d = 'abcd'
+    >>> diff([a, b, c], [a, d, c])
+    [(1, 2, ['d'])]
+    >>> diff([a, b, c, d], [d, a, b, c])
+    [(0, 0, ['d']), (3, 4, [])]
+    """
+    if len(new) == len(old):
+        changed = [i for i, (n, o) in enumerate(zip(new, old)) if n is not o]
+        if {id(new[i]) for i in changed}.isdisjoint(id(old[i]) for i in changed):
+            # Only modified pages, nothing moved: keep the runs of changed items
+            ops = []
+            for i in changed:
+                if len(ops) > 0 and ops[-1][1] == i:
+                    ops[-1][1] += 1
+                    ops[-1][2].append(old[i])
+                else:
+                    ops.append([i, i + 1, [old[i]]])
+            return [tuple(op) for op in ops]
+    start = 0
+    while start < min(len(new), len(old)) and new[start] is old[start]:
+        start += 1
+    end = 0
+    while end < min(len(new), len(old)) - start and new[-end - 1] is old[-end - 1]:
+        end += 1
+    new_ids = [id(p) for p in new[start:len(new) - end]]
+    old_ids = [id(p) for p in old[start:len(old) - end]]
+    ops = []
+    matcher = SequenceMatcher(None, new_ids, old_ids, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            ops.append((start + i1, start + i2, old[start + j1:start + j2]))
+    return ops
+
+
+def patch(pages, ops):
+    """Apply the operations returned by diff to a copy of pages.
+
+    >>> patch(list('abcd'), diff(list('abcd'), list('dacb')))
+    ['d', 'a', 'c', 'b']
+    """
+    pages = list(pages)
+    for start, end, items in reversed(ops):
+        pages[start:end] = items
+    return pages
+
+
 @dataclass
 class State:
     label: str
-    pages: list[Page]
+    #: The pages, only for the newest state
+    pages: Optional[list[Page]]
     selection: list[int]
     vadj_percent: float
+    #: The operations which transform the pages of the next state into the pages of this state
+    delta: Optional[list] = field(default_factory=list)
+    #: Offset and length of the delta in the journal file if it is not kept in memory
+    journal: Optional[tuple[int, int]] = None
+    #: Estimated memory used by the pages or the delta
+    size: int = 0
+
+
+def page_size(page):
+    """Estimated memory used by a snapshot page in bytes"""
+    size = sys.getsizeof(page) + sys.getsizeof(page.__dict__) + sys.getsizeof(page.description)
+    for lp in page.layerpages:
+        size += sys.getsizeof(lp) + sys.getsizeof(lp.__dict__)
+    return size
+
+
+def pages_size(pages):
+    """Estimated memory used by a list of snapshot pages in bytes"""
+    return sys.getsizeof(pages) + sum(page_size(p) for p in pages)
+
+
+def delta_size(delta):
+    """Estimated memory used by a delta in bytes"""
+    return sys.getsizeof(delta) + sum(pages_size(items) for _start, _end, items in delta)
 
 
 class Manager(object):
@@ -50,21 +142,27 @@ class Manager(object):
         self.current = 0
         self.undoaction = None
         self.redoaction = None
+        #: The last snapshot of each page of the model and the serialization it was made from
+        self.snapshots = weakref.WeakKeyDictionary()
+        self.journal = None
 
     def clear(self):
         self.states = []
         self.label = None
         self.current = 0
+        self.snapshots.clear()
+        self.close_journal()
 
     def commit(self, label):
         """
         Must be called *BEFORE* each undoable actions
         :param label: label of the action
         """
-        self.states = self.states[:self.current]
-        self.states.append(self.get_state())
+        self.truncate()
+        self.push(self.get_state())
         self.current += 1
         self.label = label
+        self.compact()
         self.__refresh()
 
     def get_state(self):
@@ -76,22 +174,154 @@ class Manager(object):
         3. Which page numbers are selected
         4. The vertical adjustment percent value
         """
-        pages = [row[0].duplicate(False) for row in self.model]
+        pages = [self.snapshot(row[0]) for row in self.model]
         s = self.app.iconview.get_selected_items()
         selection = [path.get_indices()[0] for path in s]
         vadj_percent = self.app.vadj_percent_handler()
         return State(self.label, pages, selection, vadj_percent)
 
+    def snapshot(self, page):
+        """A copy of page, shared with the previous snapshot if the page did not change"""
+        key = page.serialize()
+        snapshot = self.snapshots.get(page)
+        if snapshot is None or snapshot[0] != key:
+            snapshot = key, page.duplicate(False)
+            self.snapshots[page] = snapshot
+        return snapshot[1]
+
+    def truncate(self):
+        """Remove the states after the current one, they cannot be redone anymore"""
+        if self.current < len(self.states):
+            if self.current > 0:
+                state = self.states[self.current - 1]
+                state.pages = self.pages(self.current - 1)
+                state.delta, state.journal = [], None
+                state.size = pages_size(state.pages)
+            self.states = self.states[:self.current]
+
+    def push(self, state):
+        """Append a state, only the difference with it is kept in the previous newest state"""
+        if len(self.states) > 0:
+            previous = self.states[-1]
+            previous.delta = diff(state.pages, previous.pages)
+            previous.pages = None
+            previous.size = delta_size(previous.delta)
+        state.size = pages_size(state.pages)
+        self.states.append(state)
+
+    def compact(self):
+        """Apply the limits of the history, see Config.undo_steps and Config.undo_memory"""
+        max_steps = self.app.config.undo_steps()
+        while 0 < max_steps < len(self.states) and self.current > 0:
+            del self.states[0]
+            self.current -= 1
+        self.reclaim()
+        max_memory = self.app.config.undo_memory() * 2**20
+        memory = self.memory()
+        # The newest state must stay in memory, it is needed for all the other ones
+        for state in self.states[:-1]:
+            if memory <= max_memory:
+                break
+            if state.delta is not None:
+                memory -= state.size
+                self.spill(state)
+        self.__refresh()
+
+    def memory(self):
+        """Estimated memory used by the history in bytes"""
+        return sum(state.size for state in self.states if state.journal is None)
+
+    def usage(self):
+        """Number of undo steps, memory used and size of the journal file in bytes"""
+        journal = 0 if self.journal is None else self.journal.seek(0, os.SEEK_END)
+        return self.current, self.memory(), journal
+
+    def spill(self, state):
+        """Move the delta of state to the journal file"""
+        if self.journal is None:
+            self.journal = open(os.path.join(self.app.tmp_dir, 'undo-journal'), 'w+b')
+        data = pickle.dumps(state.delta, protocol=pickle.HIGHEST_PROTOCOL)
+        offset = self.journal.seek(0, os.SEEK_END)
+        self.journal.write(data)
+        state.journal = offset, len(data)
+        state.delta = None
+
+    def reclaim(self):
+        """Remove the deltas of the dropped states from the journal file"""
+        if self.journal is None:
+            return
+        spilled = sorted((s for s in self.states if s.journal is not None),
+                         key=lambda s: s.journal[0])
+        if len(spilled) == 0:
+            self.close_journal()
+            return
+        used = sum(length for _offset, length in (s.journal for s in spilled))
+        end = spilled[-1].journal[0] + spilled[-1].journal[1]
+        if end > 2 * used:
+            # Mostly unused, move the deltas to the beginning of the file
+            end = 0
+            for state in spilled:
+                offset, length = state.journal
+                if offset != end:
+                    self.journal.seek(offset)
+                    data = self.journal.read(length)
+                    self.journal.seek(end)
+                    self.journal.write(data)
+                    state.journal = end, length
+                end += length
+        self.journal.truncate(end)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            os.remove(self.journal.name)
+            self.journal = None
+
+    def delta(self, state):
+        """The delta of state, read from the journal file if needed"""
+        if state.delta is not None:
+            return state.delta
+        offset, length = state.journal
+        self.journal.seek(offset)
+        return pickle.loads(self.journal.read(length))
+
+    def pages(self, n):
+        """The pages of the state n"""
+        pages = self.states[-1].pages
+        for state in reversed(self.states[n:-1]):
+            pages = patch(pages, self.delta(state))
+        return pages
+
+    def restore(self, snapshot, old=None):
+        """A new page for the model from a snapshot.
+
+        The thumbnail of old, the page it replaces, is kept if only the rotation changed.
+        """
+        # Snapshots are shared by several states, they must not be modified
+        page = snapshot.duplicate(False)
+        self.snapshots[page] = page.serialize(), snapshot
+        # Do not reset the zoom level
+        page.zoom = self.app.zoom_scale
+        page.resample = -1
+        if old is not None:
+            rotated = page.duplicate(False)
+            rotated.rotate(old.angle - page.angle)
+            if rotated.serialize() == old.serialize():
+                page.thumbnail = old.thumbnail
+                page.preview = old.preview
+                page.resample = old.resample
+        return page
+
     def undo(self, _action, _param, _unused):
         if self.current == len(self.states):
-            self.states.append(self.get_state())
-        self.__set_state(self.states[self.current - 1])
+            self.push(self.get_state())
+        self.__set_state(self.current - 1)
         self.current -= 1
         self.app.set_unsaved(True)
         self.__refresh()
 
     def redo(self, _action, _param, _unused):
-        self.__set_state(self.states[self.current + 1])
+        self.__set_state(self.current + 1)
         self.current += 1
         self.app.set_unsaved(True)
         self.__refresh()
@@ -101,16 +331,30 @@ class Manager(object):
         self.redoaction = redo
         self.__refresh()
 
-    def __set_state(self, state):
+    def __set_state(self, n):
+        """Patch the model into the state n, unchanged pages keep their thumbnail"""
+        state = self.states[n]
+        pages = self.pages(n)
+        ops = diff([self.snapshot(row[0]) for row in self.model], pages)
         self.app.quit_rendering()
         self.app.iconview.unselect_all()
         with self.app.render_lock():
-            self.model.clear()
-            for page in state.pages:
-                # Do not reset the zoom level
-                page.zoom = self.app.zoom_scale
-                page.resample = -1
-                self.model.append([page, page.description])
+            # Pages which are removed at a place and inserted at another one
+            removed = {}
+            for start, end, _items in ops:
+                for i in range(start, end):
+                    page = self.model[i][0]
+                    removed.setdefault(id(self.snapshots[page][1]), []).append(page)
+            for start, end, items in reversed(ops):
+                old = [self.model[i][0] for i in range(start, end)]
+                for i in reversed(range(start, end)):
+                    self.model.remove(self.model.get_iter(i))
+                for i, snapshot in enumerate(items):
+                    if len(removed.get(id(snapshot), [])) > 0:
+                        page = removed[id(snapshot)].pop()
+                    else:
+                        page = self.restore(snapshot, old[i] if len(old) == len(items) else None)
+                    self.model.insert(start + i, [page, page.description])
         for num in state.selection:
             self.app.iconview.select_path(self.model[num].path)
         self.app.vadj_percent = state.vadj_percent
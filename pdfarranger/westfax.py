@@ -17,6 +17,8 @@ from typing import Optional
 import requests
 from gi.repository import Gtk
 
+from .exporter import optimize_for_fax
+
 _ = gettext.gettext
 
 WESTFAX_SEND_URL = "https://api2.westfax.com/REST/Fax_SendFax/json"
@@ -158,6 +160,10 @@ def make_westfax_send_handler(app):
         chk_receipt.set_active(True)
         grid.attach(chk_receipt, 1, 7, 2, 1)
 
+        chk_optimize = Gtk.CheckButton(label=_("Optimize for fax (black & white, 200 dpi)"))
+        chk_optimize.set_active(app.config.fax_optimize())
+        grid.attach(chk_optimize, 1, 8, 2, 1)
+
         d.vbox.pack_start(grid, True, True, 0)        
 
         # load cover pages here
@@ -308,6 +314,8 @@ def make_westfax_send_handler(app):
         ).strip()
 
         send_receipt = chk_receipt.get_active()
+        fax_optimize = chk_optimize.get_active()
+        app.config.set_fax_optimize(fax_optimize)
         d.destroy()
 
         if not re.fullmatch(r"\d{7,20}", to_number):
@@ -347,6 +355,21 @@ def make_westfax_send_handler(app):
             ani = re.sub(r"\D", "", (prefs.get('westfax_ani', '') or '').strip())
 
             try:
+                if fax_optimize:
+                    # Optimize to a separate file so that a failure leaves the copy intact
+                    fd, opt_pdf = tempfile.mkstemp(suffix=".pdf", prefix="westfax_",
+                                                   dir=app.tmp_dir)
+                    os.close(fd)
+                    try:
+                        optimize_for_fax(pdf_path, opt_pdf)
+                        os.replace(opt_pdf, tmp_pdf)
+                    except Exception:
+                        # Send the unmodified copy
+                        try:
+                            os.remove(opt_pdf)
+                        except OSError:
+                            pass
+
                 feedback_email = None
                 if send_receipt:
                     feedback_email = (prefs.get("westfax_user_email") or "").strip()
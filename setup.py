@@ -119,10 +119,12 @@ setup(
         "build_icons": build_icons,
     },
     entry_points={
-        'console_scripts': ['pdfarranger=pdfarranger.pdfarranger:main']
+        'console_scripts': ['pdfarranger=pdfarranger.pdfarranger:main',
+                            'pdfarranger-batch=pdfarranger.batch:main']
     },
     install_requires=['pikepdf>=6','python-dateutil>=2.4.0', 'packaging'],
     extras_require={
         'image': ['img2pdf>=0.3.4'],
+        'search': ['pyahocorasick'],
     },
 )
@@ -0,0 +1,258 @@
+"""Export benchmarks on large synthetic documents.
+
+This is not a unit test. Run it from the root of the source tree::
+
+    python3 -m tests.benchmark                       # run all cases
+    python3 -m tests.benchmark --quick text layers   # small documents, some inputs only
+    python3 -m tests.benchmark --save-baseline bench.json
+    python3 -m tests.benchmark --baseline bench.json --tolerance 0.15
+
+Each case runs in a fresh process so that the reported peak RSS is the one of
+the case alone. When a baseline is given, the exit status is 1 if any case is
+slower, or uses more memory, than the baseline by more than the tolerance.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pikepdf
+from pikepdf import Dictionary, Name, Array
+
+from pdfarranger import exporter
+from pdfarranger.pages import Dims, LayerPage, Page, Sides
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+#: Number of pages of the synthetic inputs, the second value is for --quick
+SIZES = {
+    'text': (10000, 500),
+    'scans': (200, 20),
+    'forms': (1000, 50),
+    'layers': (500, 50),
+}
+
+#: Number of layers of each page of the 'layers' input
+LAYER_DEPTH = 16
+
+#: Split exports and white border detection only use the first pages of the inputs
+SPLIT_PAGES = 200
+BORDER_PAGES = 20
+
+
+def _text_pdf(filename, npages):
+    """Pages of text sharing a single font"""
+    pdf = pikepdf.new()
+    font = pdf.make_indirect(Dictionary(Type=Name.Font, Subtype=Name.Type1,
+                                        BaseFont=Name.Helvetica))
+    for n in range(npages):
+        lines = [f'({n + 1}.{i} The quick brown fox jumps over the lazy dog) Tj T*'
+                 for i in range(45)]
+        content = 'BT /F1 11 Tf 14 TL 72 740 Td ' + ' '.join(lines) + ' ET'
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.Resources = Dictionary(Font=Dictionary(F1=font))
+        page.Contents = pdf.make_stream(content.encode())
+    pdf.save(filename)
+
+
+def _scans_pdf(filename, npages, seed=0):
+    """Pages with one unique 1 bit 200 dpi image each, like scanned documents"""
+    width, height = 1700, 2200
+    rnd = random.Random(seed)
+    rows = [bytes(255 if rnd.random() < 0.97 else rnd.randrange(256) for _ in range(width // 8))
+            for _ in range(64)]
+    pdf = pikepdf.new()
+    for _n in range(npages):
+        data = b''.join(rnd.choice(rows) for _ in range(height))
+        image = pdf.make_stream(zlib.compress(data), Type=Name.XObject, Subtype=Name.Image,
+                                Width=width, Height=height, ColorSpace=Name.DeviceGray,
+                                BitsPerComponent=1, Filter=Name.FlateDecode)
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.Resources = Dictionary(XObject=Dictionary(Im0=image))
+        page.Contents = pdf.make_stream(b'q 612 0 0 792 0 0 cm /Im0 Do Q')
+    pdf.save(filename)
+
+
+def _forms_pdf(filename, npages, nfields=40):
+    """Pages with many text fields, each with its own appearance stream"""
+    pdf = pikepdf.new()
+    fields = Array()
+    for n in range(npages):
+        page = pdf.add_blank_page(page_size=(612, 792))
+        annots = Array()
+        for i in range(nfields):
+            y = 760 - 18 * i
+            ap = pdf.make_stream(f'/Tx BMC BT /Helv 9 Tf 2 4 Td (value {n}.{i}) Tj ET EMC'.encode(),
+                                 Type=Name.XObject, Subtype=Name.Form, BBox=[0, 0, 200, 16])
+            widget = pdf.make_indirect(Dictionary(
+                Type=Name.Annot, Subtype=Name.Widget, FT=Name.Tx, T=f'field{n}_{i}',
+                V=f'value {n}.{i}', Rect=[72, y, 272, y + 16], F=4, P=page.obj,
+                AP=Dictionary(N=ap)))
+            annots.append(widget)
+            fields.append(widget)
+        page.Annots = annots
+    pdf.Root.AcroForm = Dictionary(Fields=fields, DA='/Helv 0 Tf 0 g')
+    pdf.save(filename)
+
+
+GENERATORS = {'text': _text_pdf, 'scans': _scans_pdf, 'forms': _forms_pdf, 'layers': _text_pdf}
+
+
+def _page(nfile, npage, filename, pdf):
+    x1, y1, x2, y2 = exporter._mediabox(pdf.pages[npage - 1])
+    size = Dims(float(x2 - x1), float(y2 - y1))
+    return Page(nfile, npage, 1.0, filename, 0, 1.0, Sides(), Sides(), size, '', [])
+
+
+def _pages(kind, filename, pdf, npages):
+    pages = [_page(1, n + 1, filename, pdf) for n in range(npages)]
+    if kind == 'layers':
+        for n, p in enumerate(pages):
+            for depth in range(LAYER_DEPTH):
+                lp = pages[(n + depth + 1) % npages]
+                offset = Sides(*([0.02 * (depth % 8)] * 4))
+                p.layerpages.append(LayerPage(1, lp.npage, filename, 90 * (depth % 4), 0.5,
+                                              Sides(), offset, 'OVERLAY', lp.size_orig))
+    else:
+        # Make a quarter of the pages go through the geometrical transformations
+        for p in pages[::4]:
+            p.rotate(90)
+            p.crop = Sides(0.05, 0.05, 0.1, 0.1)
+    return pages
+
+
+def _peak_rss():
+    """Peak resident set size of the current process in MiB"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _white_borders(filename, pages):
+    from pdfarranger.pageutils import white_borders
+    model = [[p] for p in pages]
+    pdfqueue = [types.SimpleNamespace(copyname=filename, password='')]
+    white_borders(model, list(range(len(pages))), pdfqueue)
+
+
+def _run_case(kind, method, filename, npages, outdir):
+    """Run one benchmark case in the current process. Return (seconds, pages, peak RSS)."""
+    if method == 'split':
+        npages = min(npages, SPLIT_PAGES)
+    elif method == 'borders':
+        npages = min(npages, BORDER_PAGES)
+    with pikepdf.open(filename) as pdf:
+        pages = _pages(kind, filename, pdf, npages)
+        out = os.path.join(outdir, f'{kind}-{method}.pdf')
+        start = time.perf_counter()
+        if method == 'export_doc':
+            exporter.export_doc([pdf], pages, {}, [out], None)
+        elif method == 'export_doc_job':
+            exporter.export_doc_job([pdf], [(filename, '')], pages, {}, [out], None)
+        elif method == 'split':
+            files_out = [os.path.join(outdir, f'{kind}-split-{n}.pdf') for n in range(npages)]
+            exporter.export_doc([pdf], pages, {}, files_out, None)
+        elif method == 'borders':
+            _white_borders(filename, pages)
+        elapsed = time.perf_counter() - start
+    return elapsed, npages, _peak_rss()
+
+
+def _methods():
+    methods = ['export_doc']
+    if hasattr(pikepdf, 'Job'):
+        methods.append('export_doc_job')
+    methods.append('split')
+    try:
+        from pdfarranger import pageutils  # noqa: F401 needs Gtk and Poppler
+        methods.append('borders')
+    except (ImportError, ValueError):
+        print('Gtk or Poppler not available, white border detection not benchmarked',
+              file=sys.stderr)
+    return methods
+
+
+def _compare(results, baseline, tolerance):
+    """Print the comparison with the baseline. Return the number of regressions."""
+    regressions = 0
+    for key, r in results.items():
+        if key not in baseline:
+            continue
+        ratio = r['pages_per_s'] / baseline[key]['pages_per_s']
+        regression = ratio < 1 - tolerance
+        line = f"{key:28} {ratio:6.2f}x speed"
+        rss, base_rss = r['peak_rss'], baseline[key].get('peak_rss')
+        if rss is not None and base_rss:
+            rss_ratio = rss / base_rss
+            regression = regression or rss_ratio > 1 + tolerance
+            line += f" {rss_ratio:6.2f}x memory"
+        regressions += regression
+        print(f"{line} of baseline{'  REGRESSION' if regression else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m tests.benchmark', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', metavar='INPUT',
+                        help=f"synthetic inputs to benchmark among {', '.join(SIZES)} (default all)")
+    parser.add_argument('--quick', action='store_true', help='use small documents')
+    parser.add_argument('--workdir', help='keep generated documents in this directory')
+    parser.add_argument('--baseline', help='compare with this JSON baseline')
+    parser.add_argument('--save-baseline', metavar='FILE', help='save the results as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown or memory increase before reporting a regression'
+                             ' (default 0.1)')
+    args = parser.parse_args(argv)
+    inputs = args.inputs or list(SIZES)
+    for kind in inputs:
+        if kind not in SIZES:
+            parser.error(f'unknown input {kind!r}')
+
+    tmpdir = tempfile.TemporaryDirectory(prefix='pdfarranger-bench-')
+    workdir = args.workdir or tmpdir.name
+    os.makedirs(workdir, exist_ok=True)
+    methods = _methods()
+    results = {}
+    # spawn so that the peak RSS does not include the memory of the parent process
+    context = multiprocessing.get_context('spawn')
+    print(f"{'case':28} {'pages':>6} {'seconds':>8} {'pages/s':>9} {'peak MiB':>9}")
+    for kind in inputs:
+        npages = SIZES[kind][args.quick]
+        filename = os.path.join(workdir, f'{kind}-{npages}.pdf')
+        if not os.path.exists(filename):
+            GENERATORS[kind](filename, npages)
+        for method in methods:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(_run_case, kind, method, filename, npages, tmpdir.name)
+                elapsed, n, rss = future.result()
+            key = f'{kind}/{method}'
+            results[key] = dict(pages=n, seconds=elapsed, pages_per_s=n / elapsed, peak_rss=rss)
+            rss = '' if rss is None else f'{rss:9.1f}'
+            print(f'{key:28} {n:6} {elapsed:8.2f} {n / elapsed:9.1f} {rss:>9}')
+    tmpdir.cleanup()
+
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = _compare(results, json.load(f), args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import contextlib
+import doctest
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import pikepdf
+
+import pdfarranger.batch as batch
+
+
+def file(name):
+    """Expand name to full filename"""
+    return f'./tests/exporter/{name}.pdf'
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def output(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test01(self):
+        """Merge, rotate and insert blank pages"""
+        job = {'output': self.output('out.pdf'),
+               'pages': [{'file': file('basic'), 'pages': '1-2', 'rotate': 90},
+                         {'blank': True},
+                         {'file': file('outlines'), 'pages': '4'}]}
+        self.assertEqual(batch.run_job(job), [job['output']])
+        with pikepdf.open(job['output']) as pdf:
+            self.assertEqual(len(pdf.pages), 4)
+            self.assertEqual(pdf.pages[0].Rotate, 90)
+            self.assertEqual(len(pdf.pages[2].Contents.read_bytes()), 0)
+
+    def test02(self):
+        """N-up and split"""
+        job = {'output': self.output('out.pdf'), 'nup': [2, 1], 'split': True,
+               'pages': [{'file': file('basic'), 'pages': '1,2,6'}]}
+        files_out = batch.run_job(job)
+        self.assertEqual([os.path.basename(f) for f in files_out], ['out.pdf', 'out-002.pdf'])
+        with pikepdf.open(files_out[0]) as pdf:
+            self.assertEqual(len(pdf.pages), 1)
+            self.assertEqual([float(x) for x in pdf.pages[0].MediaBox], [0, 0, 1224, 792])
+
+    def test03(self):
+        """Command line"""
+        out = self.output('out.pdf')
+        self.assertEqual(batch.main(['-o', out, file('basic') + '#3-4', '--rotate', '180']), 0)
+        with pikepdf.open(out) as pdf:
+            self.assertEqual(len(pdf.pages), 2)
+        self.assertEqual(batch.main(['-o', out, 'missing.pdf']), 1)
+
+    def test04(self):
+        """Rotations which are not a multiple of 90 are rejected"""
+        job = {'output': self.output('out.pdf'),
+               'pages': [{'file': file('basic'), 'pages': '1', 'rotate': 45}]}
+        with self.assertRaisesRegex(ValueError, 'rotation 45'):
+            batch.run_job(job)
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            batch.main(['-o', job['output'], file('basic'), '--rotate', '45'])
+        self.assertFalse(os.path.exists(job['output']))
+
+    def test05(self):
+        """The batch interface does not import Gtk or Poppler"""
+        code = "import sys, pdfarranger.batch; assert 'gi' not in sys.modules"
+        self.assertEqual(subprocess.run([sys.executable, '-c', code]).returncode, 0)
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(batch))
+    return tests
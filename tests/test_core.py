@@ -1,7 +1,20 @@
 import doctest
+import os
+import shutil
+import tempfile
+import types
 import unittest
+from unittest import mock
 
+import pikepdf
+
+import pdfarranger.cache as cache
 import pdfarranger.core as core
+import pdfarranger.pages as pages
+import pdfarranger.printing as printing
+import pdfarranger.textindex as textindex
+import pdfarranger.transfer as transfer
+import pdfarranger.undo as undo
 
 
 class PTest(unittest.TestCase):
@@ -163,6 +176,88 @@ class LayerPageTest(PTest):
                          'lcopy///4///90///2///OVERLAY///0.11///0.21///0.31///0.41///0.12///0.22///0.32///0.42')
 
 
+class TransferTest(PTest):
+
+    def test01(self):
+        """Test pack and unpack"""
+        pages = [self._page1(), self._page1_90()]
+        pages[1].description = 'é\n///'
+        data = [transfer.page_data(p) for p in pages]
+        self.assertEqual(transfer.unpack(transfer.pack(data)), data)
+        self.assertEqual(transfer.from_text(transfer.to_text(transfer.pack(data))), data)
+
+    def test02(self):
+        """Test invalid data"""
+        buf = bytearray(transfer.pack([transfer.page_data(self._page1())]))
+        buf[-1] ^= 1
+        self.assertRaises(ValueError, transfer.unpack, buf)
+        self.assertRaises(ValueError, transfer.unpack, b'PDFA')
+        self.assertRaises(ValueError, transfer.from_text, transfer.CLIPBOARD_ID + '#')
+
+
+class InMemoryCacheTest(unittest.TestCase):
+    """Test the caches of printing.get_in_memory_poppler_doc"""
+
+    def setUp(self):
+        printing.clear_in_memory_cache()
+        self.addCleanup(printing.clear_in_memory_cache)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.pdfqueue = []
+        for n in range(4):
+            copyname = os.path.join(tmpdir.name, f'{n}.pdf')
+            shutil.copy('./tests/exporter/basic.pdf', copyname)
+            self.pdfqueue.append(types.SimpleNamespace(copyname=copyname, password=''))
+
+    def _page(self, nfile=1, npage=1):
+        return core.Page(nfile, npage, 1.0, self.pdfqueue[nfile - 1].copyname, 0, 1, core.Sides(),
+                         core.Sides(), core.Dims(612, 792), 'basic', [])
+
+    def test01(self):
+        """A single page export is cached until the page changes"""
+        doc = printing.get_in_memory_poppler_doc([self._page()], self.pdfqueue)
+        self.assertIs(printing.get_in_memory_poppler_doc([self._page()], self.pdfqueue), doc)
+        rotated, scaled, hidden, cropped = [self._page() for _ in range(4)]
+        rotated.rotate(90)
+        scaled.scale = 2
+        hidden.hide = core.Sides(0.1, 0, 0, 0)
+        cropped.crop = core.Sides(0, 0.1, 0, 0)
+        for page in [rotated, scaled, hidden, cropped]:
+            self.assertIsNot(printing.get_in_memory_poppler_doc([page], self.pdfqueue), doc)
+        self.assertEqual(len(printing._page_cache), 5)
+
+    def test02(self):
+        """The inputs of an export are not evicted while it runs"""
+        pages = [self._page(nfile) for nfile in (1, 2, 3)]
+        with mock.patch.object(printing._input_cache, 'maxsize', 2), \
+                mock.patch.object(pikepdf.Pdf, 'close', autospec=True,
+                                  side_effect=pikepdf.Pdf.close) as close:
+            printing.get_in_memory_poppler_doc(pages, self.pdfqueue)
+            close.assert_not_called()
+            self.assertEqual(len(printing._input_cache), 3)
+            # The next export evicts the least recently used inputs
+            printing.get_in_memory_poppler_doc([self._page(4)], self.pdfqueue)
+            self.assertEqual(close.call_count, 2)
+            self.assertEqual(list(printing._input_cache), [(self.pdfqueue[n].copyname, '') for n in (2, 3)])
+
+    def test03(self):
+        """clear_in_memory_cache closes the cached inputs"""
+        printing.get_in_memory_poppler_doc([self._page(1), self._page(2)], self.pdfqueue)
+        inputs = list(printing._input_cache.values())
+        self.assertEqual(len(inputs), 2)
+        with mock.patch.object(pikepdf.Pdf, 'close', autospec=True,
+                               side_effect=pikepdf.Pdf.close) as close:
+            printing.clear_in_memory_cache()
+        self.assertCountEqual([c.args[0] for c in close.call_args_list], inputs)
+        self.assertEqual(len(printing._input_cache), 0)
+        self.assertEqual(len(printing._page_cache), 0)
+
+
 def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(cache))
     tests.addTests(doctest.DocTestSuite(core))
+    tests.addTests(doctest.DocTestSuite(pages))
+    tests.addTests(doctest.DocTestSuite(textindex))
+    tests.addTests(doctest.DocTestSuite(transfer))
+    tests.addTests(doctest.DocTestSuite(undo))
     return tests
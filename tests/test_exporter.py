@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field
 import os
+import tempfile
 import packaging.version as version
 from typing import Any, List, Tuple
 import unittest
@@ -7,8 +8,8 @@ from unittest.mock import Mock
 
 import pikepdf
 
-from pdfarranger.exporter import export
-from pdfarranger.core import Dims, Sides
+from pdfarranger.exporter import export, get_blank_doc, _deduplicate_resources, _fax_optimize, _resources_to_prune
+from pdfarranger.pages import Dims, Sides
 
 
 # The test files used for the tests in this file are in QDF format (see
@@ -20,6 +21,17 @@ def file(name):
     return f'./tests/exporter/{name}.pdf'
 
 
+def _mock_config(**overrides):
+    """Mock Config returning the default settings or the given overrides"""
+    settings = dict(start_with_empty=True, deduplicate_resources=False, incremental_save=False,
+                    save_options={}, chunk_size=0)
+    settings.update(overrides)
+    config = Mock()
+    for name, value in settings.items():
+        getattr(config, name).return_value = value
+    return config
+
+
 @dataclass
 class Page:
     """Mock Page class"""
@@ -102,9 +114,8 @@ class ExporterTest(unittest.TestCase):
             if not os.path.exists(expected_file):
                 expected_file = file(f'test{test}_out')
 
-        mock_config = Mock()
-        mock_config.start_with_empty.return_value = start_with_empty
-        export(files, pages, {}, [file('out')], mock_config, None, True)
+        export(files, pages, {}, [file('out')], _mock_config(start_with_empty=start_with_empty), None,
+               True)
         self.assertTrue(*self.compare_files(file('out'), expected_file))
 
     def basic(self, test, *pages):
@@ -245,3 +256,185 @@ class ExporterTest(unittest.TestCase):
             Page(1),
             Page(1, nfile=2),
         )
+
+
+class PruneTest(unittest.TestCase):
+
+    def test01(self):
+        """Only pages sharing resources in their source are pruned"""
+        pdf_input = [pikepdf.open(file('basic'))]
+        prune = _resources_to_prune(pdf_input, [Page(1), Page(5), Page(1, layerpages=[LayerPage(6)])])
+        self.assertEqual(prune, [False, True, True])
+
+
+class DeduplicateTest(unittest.TestCase):
+
+    @staticmethod
+    def _pdf_with_image():
+        pdf = pikepdf.Pdf.new()
+        pdf.add_blank_page()
+        image = pdf.make_stream(b'\xff' * 16, Type=pikepdf.Name.XObject, Subtype=pikepdf.Name.Image,
+                                Width=4, Height=4, ColorSpace=pikepdf.Name.DeviceGray,
+                                BitsPerComponent=8)
+        pdf.pages[0].Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+        return pdf
+
+    def test01(self):
+        """Identical images from different files are merged"""
+        pdf_output = pikepdf.Pdf.new()
+        pdf_output.pages.extend(self._pdf_with_image().pages)
+        pdf_output.pages.extend(self._pdf_with_image().pages)
+        im = [p.Resources.XObject.Im0 for p in pdf_output.pages]
+        self.assertNotEqual(im[0].objgen, im[1].objgen)
+        _deduplicate_resources(pdf_output)
+        im = [p.Resources.XObject.Im0 for p in pdf_output.pages]
+        self.assertEqual(im[0].objgen, im[1].objgen)
+
+
+class FaxTest(unittest.TestCase):
+
+    def test01(self):
+        """Images are downsampled to black & white CCITT G4"""
+        pdf = pikepdf.Pdf.new()
+        pdf.add_blank_page(page_size=(72, 72))
+        image = pdf.make_stream(bytes(range(250)) * 4000, Type=pikepdf.Name.XObject,
+                                Subtype=pikepdf.Name.Image, Width=1000, Height=1000,
+                                ColorSpace=pikepdf.Name.DeviceGray, BitsPerComponent=8)
+        pdf.pages[0].Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+        _fax_optimize(pdf, dpi=200)
+        image = pdf.pages[0].Resources.XObject.Im0
+        self.assertEqual((image.Width, image.Height, image.BitsPerComponent), (200, 200, 1))
+        self.assertEqual(image.Filter, pikepdf.Name.CCITTFaxDecode)
+        self.assertEqual(pikepdf.PdfImage(image).as_pil_image().size, (200, 200))
+
+
+class SaveOptionsTest(unittest.TestCase):
+
+    def test01(self):
+        """Linearized output with object streams"""
+        mock_config = _mock_config(save_options={'linearize': True, 'object_streams': 'generate',
+                                                 'compression_level': -1})
+        export([(file('basic'), '')], [Page(1), Page(2)], {}, [file('out')], mock_config, None)
+        with pikepdf.open(file('out')) as pdf:
+            self.assertTrue(pdf.is_linearized)
+            self.assertEqual(len(pdf.pages), 2)
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def _update(self, src, object_streams=False):
+        """Reorder and remove pages of a copy of src, saving over it"""
+        fd, name = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        self.addCleanup(os.remove, name)
+        with pikepdf.open(src) as pdf:
+            mode = pikepdf.ObjectStreamMode.generate if object_streams else pikepdf.ObjectStreamMode.disable
+            pdf.save(name, object_stream_mode=mode)
+        with open(name, 'rb') as f:
+            original = f.read()
+        s = os.stat(name)
+        mock_config = _mock_config(incremental_save=True,
+                                   save_options={'linearize': False, 'object_streams': 'preserve',
+                                                 'compression_level': -1})
+        export([(name, '')], [Page(3), Page(1)], {}, [name], mock_config, None,
+               sources=[(name, (s.st_dev, s.st_ino, s.st_mtime))])
+        mock_config.start_with_empty.assert_not_called()
+        with open(name, 'rb') as f:
+            self.assertTrue(f.read().startswith(original))
+        with pikepdf.open(name) as pdf, pikepdf.open(src) as pdf_src:
+            self.assertEqual(pdf.get_warnings(), [])
+            self.assertEqual(len(pdf.pages), 2)
+            self.assertEqual(pdf.pages[0].Contents.read_bytes(), pdf_src.pages[2].Contents.read_bytes())
+            self.assertEqual(pdf.pages[1].Contents.read_bytes(), pdf_src.pages[0].Contents.read_bytes())
+
+    def test01(self):
+        """Incremental update with a cross-reference table"""
+        self._update(file('basic'))
+
+    def test02(self):
+        """Incremental update with a cross-reference stream"""
+        self._update(file('basic'), object_streams=True)
+
+
+class ChunkTest(unittest.TestCase):
+
+    def _export(self, pages, files_out, chunk_size, dedup=False):
+        export([(file('basic'), '')], pages, {}, files_out,
+               _mock_config(chunk_size=chunk_size, deduplicate_resources=dedup), None)
+
+    def test01(self):
+        """Chunked export gives the same pages as a single pass"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        pages = [Page(n) for n in range(1, 8)] + [Page(1, layerpages=[LayerPage(6)]), Page(2, angle=90),
+                                                   Page(3, layerpages=[LayerPage(6)])]
+        single, chunked = os.path.join(tmpdir.name, 'single.pdf'), os.path.join(tmpdir.name, 'chunked.pdf')
+        self._export(pages, [single], 0)
+        self._export(pages, [chunked], 2)
+        with pikepdf.open(single) as pdf1, pikepdf.open(chunked) as pdf2:
+            self.assertEqual(len(pdf1.pages), len(pdf2.pages))
+            for page1, page2 in zip(pdf1.pages, pdf2.pages):
+                self.assertEqual(page1.get('/Rotate'), page2.get('/Rotate'))
+                self.assertEqual(list(page1.MediaBox), list(page2.MediaBox))
+        # The overlay is used in two chunks but only stored once if deduplication is enabled
+        self._export(pages, [chunked], 2, dedup=True)
+        with pikepdf.open(chunked) as pdf:
+            layers = [list(pdf.pages[n].Resources.XObject.values())[0] for n in (7, 9)]
+            self.assertEqual(layers[0].objgen, layers[1].objgen)
+
+    def test02(self):
+        """Chunked export to multiple files"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        files_out = [os.path.join(tmpdir.name, f'{n}.pdf') for n in range(5)]
+        self._export([Page(n) for n in range(1, 6)], files_out, 2)
+        for n, f in enumerate(files_out):
+            with pikepdf.open(f) as pdf:
+                self.assertEqual(len(pdf.pages), 1)
+
+
+class UnmodifiedTest(unittest.TestCase):
+
+    def test01(self):
+        """Unmodified pages are copied without geometrical transformation"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        src, out = os.path.join(tmpdir.name, 'src.pdf'), os.path.join(tmpdir.name, 'out.pdf')
+        with pikepdf.new() as pdf:
+            pdf.add_blank_page()
+            pdf.pages[0].CropBox = [10, 10, 600, 780]
+            pdf.save(src)
+        export([(src, '')], [Page(1, copyname=src), Page(1, copyname=src, angle=90)], {}, [out],
+               _mock_config(), None)
+        with pikepdf.open(out) as pdf:
+            self.assertEqual(list(pdf.pages[0].CropBox), [10, 10, 600, 780])
+            self.assertNotIn('/CropBox', pdf.pages[1])
+            self.assertEqual(list(pdf.pages[1].MediaBox), [10, 10, 600, 780])
+
+
+class BlankDocTest(unittest.TestCase):
+
+    def test01(self):
+        """Blank documents are reused for any smaller number of pages"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        pdfqueue = []
+
+        def get_pdfdoc(filename, description, blank_size):
+            with pikepdf.open(filename) as pdf:
+                npages = len(pdf.pages)
+            document = Mock()
+            document.get_n_pages.return_value = npages
+            pdfqueue.append(Mock(copyname=filename, blank_size=blank_size, document=document))
+            return pdfqueue[-1], len(pdfqueue), True
+
+        adder = Mock()
+        adder.get_pdfdoc.side_effect = get_pdfdoc
+        filename, nfile = get_blank_doc(adder, pdfqueue, tmpdir.name, (100, 200), 3)
+        self.assertEqual(nfile, 1)
+        self.assertEqual(pdfqueue[0].document.get_n_pages(), 8)
+        self.assertEqual(get_blank_doc(adder, pdfqueue, tmpdir.name, (100, 200), 8), (filename, 1))
+        self.assertEqual(get_blank_doc(adder, pdfqueue, tmpdir.name, (100, 200), 9)[1], 2)
+        self.assertEqual(pdfqueue[1].document.get_n_pages(), 16)
+        self.assertEqual(get_blank_doc(adder, pdfqueue, tmpdir.name, (200, 100))[1], 3)
+        self.assertEqual(len(pdfqueue), 3)